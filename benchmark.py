@@ -0,0 +1,411 @@
+"""Timing harness for Chhobi's hot paths. Run as
+
+python benchmark.py [-r repeats] [-n photos] [--size WxH] [--seed N] [--library DIR] [bench names ...]
+
+and it prints a JSON report with one entry per benchmark: latency percentiles (p50/p90/p95/p99) of the individual
+calls and, where it makes sense, the throughput. With no names given every benchmark is run.
+
+Benchmarks that work on files use a synthetic library: JPEGs made with PIL that carry EXIF (camera, dates,
+exposure, orientation and an embedded thumbnail) and IPTC keywords and captions, exactly as a camera plus a
+previous Chhobi session would leave them. The library is generated from the seed, so two runs with the same
+options see the same files. It goes in a temporary directory unless --library is given, in which case it is kept
+and reused.
+
+Nothing here needs a display. The benchmarks that talk to exiftool report 'skipped' when it is not installed, and
+the Treeview and time to first paint benchmarks report 'skipped' when Tk can't open a window.
+"""
+import logging
+logger = logging.getLogger(__name__)
+import os, sys, time, json, argparse, random, struct, shutil, tempfile, subprocess, distutils.spawn
+from cStringIO import StringIO
+from PIL import Image
+import exiftool, exifreader, exporter, searchindex, dirbrowser, thumbnails, libchhobi as lch
+
+def timeit(func, repeats=5):
+  """Call func() repeats times and return the individual wall clock times in seconds."""
+  times = []
+  for n in range(repeats):
+    t0 = time.time()
+    func()
+    times.append(time.time() - t0)
+  return times
+
+def time_each(func, items, repeats=1):
+  """Call func(item) for every item, repeats times over, and return the individual times."""
+  times = []
+  for n in range(repeats):
+    for item in items:
+      t0 = time.time()
+      func(item)
+      times.append(time.time() - t0)
+  return times
+
+def percentile(sorted_times, p):
+  return sorted_times[min(int(len(sorted_times) * p / 100.0), len(sorted_times) - 1)]
+
+def summarize(times, n_bytes=None, n_items=None):
+  """n_bytes and n_items are per call, and give MB_per_s and items_per_s at the median."""
+  times = sorted(times)
+  summary = {
+    'repeats': len(times),
+    'min_s': times[0],
+    'median_s': times[len(times) // 2],
+    'p90_s': percentile(times, 90),
+    'p95_s': percentile(times, 95),
+    'p99_s': percentile(times, 99),
+    'max_s': times[-1]
+  }
+  if n_bytes is not None:
+    summary['MB_per_s'] = n_bytes / 1e6 / summary['median_s']
+  if n_items is not None:
+    summary['items_per_s'] = n_items / summary['median_s']
+  return summary
+
+def skipped(reason):
+  return {'skipped': reason}
+
+#Canned exiftool responses -------------------------------------------------------------------------------------------
+
+def feed_response(response, tag=1, chunk_size=65536):
+  """Push a canned exiftool response through a ResponseBuffer the way the reader thread does."""
+  responses = exiftool.ResponseBuffer()
+  for n in range(0, len(response), chunk_size):
+    responses.feed(response[n:n + chunk_size])
+    out = responses.pop(tag)
+    if out is not None:
+      return out
+
+def canned_preview_response(size=10 * 1024 * 1024, tag=1):
+  """Something shaped like the answer to a -PreviewImage -b query on a NEF."""
+  return b'\xff\xd8' + b'\x5a' * (size - 4) + b'\xff\xd9' + b'{ready%d}\n' % tag
+
+def canned_json_response(n_files=10000, tag=1):
+  """Something shaped like the answer to get_metadata_for_files on a large selection."""
+  md = [{
+    'SourceFile': '/Users/chhobi/Pictures/2013/2013-06-29/IMG_{:05d}.JPG'.format(n),
+    'FileType': 'JPEG', 'CreateDate': '2013:06:29 12:00:00', 'Model': 'Canon EOS 5D', 'LensID': 'EF24-105mm f/4L',
+    'FocalLength': '50.0 mm', 'DOF': '0.33 m (2.81 - 3.14 m)', 'ISO': 400, 'ShutterSpeed': '1/250',
+    'FNumber': 4.0, 'Caption-Abstract': 'Fireworks over the river', 'Keywords': ['fireworks', 'river'],
+    'Orientation': 1} for n in range(n_files)]
+  return json.dumps(md, indent=4) + '\n{ready%d}\n' % tag
+
+#Synthetic library ---------------------------------------------------------------------------------------------------
+
+def pack_ifd(entries, offset, next_ifd=0):
+  """A little endian TIFF IFD starting at offset, with the values that don't fit in an entry placed right after it.
+  entries are (tag, type, value) with value a str for ASCII, an int for SHORT/LONG and (num, den) for RATIONAL.
+  The length of the result does not depend on the SHORT/LONG values, so offsets can be worked out with dummies."""
+  entries = sorted(entries)
+  data_offset = offset + 2 + 12 * len(entries) + 4
+  ifd, data = [struct.pack('<H', len(entries))], []
+  for tag, typ, value in entries:
+    if typ == 2:
+      raw, count = value + b'\0', len(value) + 1
+    elif typ == 5:
+      raw, count = struct.pack('<II', *value), 1
+    else:
+      raw, count = struct.pack('<H' if typ == 3 else '<I', value), 1
+    if len(raw) <= 4:
+      ifd.append(struct.pack('<HHI', tag, typ, count) + raw.ljust(4, b'\0'))
+    else:
+      ifd.append(struct.pack('<HHII', tag, typ, count, data_offset))
+      if len(raw) % 2: raw += b'\0'
+      data.append(raw)
+      data_offset += len(raw)
+  ifd.append(struct.pack('<I', next_ifd))
+  return b''.join(ifd + data)
+
+def exif_segment(md, thumbnail_jpeg):
+  """The APP1 payload (Exif header and TIFF block) for a photo with metadata md and the given JPEG thumbnail."""
+  date = md['CreateDate'].encode('ascii')
+  exif_ifd = [(0x829a, 5, (1, int(md['ShutterSpeed'].split('/')[1]))), (0x829d, 5, (int(md['FNumber'] * 10), 10)),
+              (0x8827, 3, md['ISO']), (0x9003, 2, date), (0x9004, 2, date),
+              (0x920a, 5, (int(float(md['FocalLength'].split()[0])), 1))]
+  def _ifd0(exif_offset, ifd1_offset):
+    return pack_ifd([(0x010f, 2, b'Chhobi'), (0x0110, 2, md['Model'].encode('ascii')), (0x0112, 3, md['Orientation']),
+                     (0x8769, 4, exif_offset)], 8, ifd1_offset)
+  exif_offset = 8 + len(_ifd0(0, 0))
+  ifd1_offset = exif_offset + len(pack_ifd(exif_ifd, exif_offset))
+  def _ifd1(thumb_offset):
+    return pack_ifd([(0x0103, 3, 6), (0x0201, 4, thumb_offset), (0x0202, 4, len(thumbnail_jpeg))], ifd1_offset)
+  thumb_offset = ifd1_offset + len(_ifd1(0))
+  tiff = (b'II*\0' + struct.pack('<I', 8) + _ifd0(exif_offset, ifd1_offset) + pack_ifd(exif_ifd, exif_offset) +
+          _ifd1(thumb_offset) + thumbnail_jpeg)
+  return b'Exif\0\0' + tiff
+
+def iptc_segment(md):
+  """The APP13 payload (Photoshop image resource 0x0404) holding the IPTC caption and keywords."""
+  def _dataset(number, value):
+    return struct.pack('>BBBH', 0x1c, 2, number, len(value)) + value
+  iptc = _dataset(0, b'\0\x04') #Record version
+  iptc += b''.join(_dataset(25, k.encode('utf-8')) for k in md['Keywords'])
+  iptc += _dataset(120, md['Caption-Abstract'].encode('utf-8'))
+  if len(iptc) % 2: iptc += b'\0'
+  return b'Photoshop 3.0\0' + b'8BIM' + struct.pack('>H', 0x0404) + b'\0\0' + struct.pack('>I', len(iptc)) + iptc
+
+def jpeg_with_metadata(img, md, quality=85):
+  """Encode img as a JPEG and splice in APP1 (EXIF) and APP13 (IPTC) segments right after the SOI marker."""
+  thumb = img.copy()
+  thumb.thumbnail((160, 160), Image.ANTIALIAS)
+  out = StringIO()
+  thumb.save(out, 'JPEG', quality=75)
+  segments = b''
+  for marker, payload in [(0xe1, exif_segment(md, out.getvalue())), (0xed, iptc_segment(md))]:
+    segments += struct.pack('>BBH', 0xff, marker, len(payload) + 2) + payload
+  out = StringIO()
+  img.save(out, 'JPEG', quality=quality)
+  data = out.getvalue()
+  return data[:2] + segments + data[2:]
+
+words = ['river', 'fireworks', 'rose', 'garden', 'city', 'night', 'portrait', 'beach', 'snow', 'mountain', 'cat',
+         'market', 'bridge', 'rain', 'festival', 'forest']
+models = ['Canon EOS 5D', 'Nikon D7000', 'Fujifilm X100', 'Sony A7']
+
+class SyntheticLibrary(object):
+  """n JPEGs of size (W, H) in dirname/photos, made on first use. metadata holds what exiftool would report for
+  each file, so the search index can be built without exiftool."""
+  def __init__(self, dirname, n=200, size=(1600, 1200), seed=0):
+    self.dirname = dirname
+    self.n = n
+    self.size = size
+    self.seed = seed
+    self._metadata = None
+
+  @property
+  def photo_dir(self):
+    return os.path.join(self.dirname, 'photos')
+
+  @property
+  def metadata(self):
+    if self._metadata is None: self.generate()
+    return self._metadata
+
+  @property
+  def files(self):
+    return [(md['SourceFile'], 'file:photo') for md in self.metadata]
+
+  def generate(self):
+    rng = random.Random(self.seed)
+    if not os.path.exists(self.photo_dir): os.makedirs(self.photo_dir)
+    self._metadata = []
+    t0 = time.time()
+    for k in range(self.n):
+      md = {
+        'SourceFile': os.path.join(self.photo_dir, 'IMG_{:05d}.JPG'.format(k)),
+        'FileType': 'JPEG',
+        'CreateDate': '{:04d}:{:02d}:{:02d} {:02d}:{:02d}:00'.format(rng.randint(2005, 2014), rng.randint(1, 12),
+                                                                    rng.randint(1, 28), rng.randint(0, 23),
+                                                                    rng.randint(0, 59)),
+        'Model': rng.choice(models),
+        'FocalLength': '{:d}.0 mm'.format(rng.choice([24, 35, 50, 85, 200])),
+        'ISO': rng.choice([100, 200, 400, 1600]),
+        'ShutterSpeed': '1/{:d}'.format(rng.choice([30, 60, 125, 250, 1000])),
+        'FNumber': rng.choice([1.8, 2.8, 4.0, 5.6, 8.0]),
+        'Caption-Abstract': ' '.join(rng.sample(words, 4)).capitalize(),
+        'Keywords': rng.sample(words, rng.randint(1, 4)),
+        'Orientation': rng.choice([1, 1, 1, 3, 6, 8])
+      }
+      self._metadata.append(md)
+      if os.path.exists(md['SourceFile']): continue #Reusing a kept library
+      img = Image.new('RGB', self.size, tuple(rng.randint(0, 255) for n in range(3)))
+      img.paste(Image.effect_noise((self.size[0] // 4, self.size[1] // 4), 64).convert('RGB').resize(self.size),
+                (0, 0))
+      with open(md['SourceFile'], 'wb') as f:
+        f.write(jpeg_with_metadata(img, md))
+    logger.info('Synthetic library of {:d} photos ready in {:.1f}s'.format(self.n, time.time() - t0))
+
+#Benchmarks ----------------------------------------------------------------------------------------------------------
+
+def have_exiftool():
+  return distutils.spawn.find_executable('exiftool') is not None
+
+def started_exiftool(library):
+  """A PersistentExifTool that has already answered one query, so start up isn't counted."""
+  etool = exiftool.PersistentExifTool()
+  etool.get_metadata_for_files(library.files[:1])
+  return etool
+
+def bench_reader_preview(repeats, library):
+  response = canned_preview_response()
+  times = timeit(lambda: feed_response(response), repeats)
+  return summarize(times, len(response))
+
+def bench_reader_json(repeats, library):
+  response = canned_json_response()
+  def _parse():
+    future = exiftool.ExifFuture()
+    future.set_output(feed_response(response))
+    future.result()
+  times = timeit(_parse, repeats)
+  return summarize(times, len(response))
+
+def bench_metadata_batch(repeats, library):
+  """The whole library in one get_metadata_for_files call, as for a big selection."""
+  if not have_exiftool(): return skipped('exiftool not found')
+  files = library.files
+  etool = started_exiftool(library)
+  try:
+    return summarize(timeit(lambda: etool.get_metadata_for_files(files), repeats), n_items=len(files))
+  finally:
+    etool.close()
+
+def bench_metadata_single(repeats, library):
+  """One file at a time, as when arrowing through the browser."""
+  if not have_exiftool(): return skipped('exiftool not found')
+  etool = started_exiftool(library)
+  try:
+    return summarize(time_each(lambda fi: etool.get_metadata_for_files([fi]), library.files, repeats), n_items=1)
+  finally:
+    etool.close()
+
+def bench_thumbnail(repeats, library):
+  if not have_exiftool(): return skipped('exiftool not found')
+  etool = started_exiftool(library)
+  try:
+    return summarize(time_each(lambda fi: etool.get_thumbnail_image(fi[0]), library.files, repeats), n_items=1)
+  finally:
+    etool.close()
+
+def bench_exif_reader(repeats, library):
+  """exifreader against exiftool's get_thumbnail_image on the same files. Reading the thumbnail includes copying
+  it out of the mapping, as PIL does when decoding it. Also checks both give the same bytes."""
+  def _read(fi):
+    info = exifreader.read_exif(fi[0])
+    return info.orientation, str(info.thumbnail)
+  report = {'exif_reader': summarize(time_each(_read, library.files, repeats), n_items=1)}
+  if not have_exiftool():
+    report['exiftool'] = skipped('exiftool not found')
+    return report
+  etool = started_exiftool(library)
+  try:
+    report['exiftool'] = summarize(time_each(lambda fi: etool.get_thumbnail_image(fi[0]), library.files, repeats),
+                                   n_items=1)
+    report['same_thumbnails'] = all(str(etool.get_thumbnail_image(fi[0])) == _read(fi)[1] for fi in library.files)
+  finally:
+    etool.close()
+  report['speedup'] = report['exiftool']['median_s'] / max(report['exif_reader']['median_s'], 1e-9)
+  return report
+
+def bench_rotate(repeats, library):
+  """Rotate the whole library right and back again. Each call is timed separately."""
+  if not have_exiftool(): return skipped('exiftool not found')
+  files = library.files
+  etool = started_exiftool(library)
+  try:
+    return summarize(time_each(lambda dir: etool.rotate_images(files, dir), ['cw', 'ccw'], repeats),
+                     n_items=len(files))
+  finally:
+    etool.close()
+
+def bench_list_directory(repeats, library):
+  """The listing that fill_tree runs on its background thread."""
+  ext_map = lch.default_ext_map
+  return summarize(timeit(lambda: list(dirbrowser.list_directory(library.photo_dir, ext_map)), repeats),
+                   n_items=library.n)
+
+def bench_virtual_flat(repeats, library):
+  """Filling the search/pile pane with the whole library. Needs Tk to be able to open a (hidden) window."""
+  import Tkinter as tki
+  try:
+    root = tki.Tk()
+  except tki.TclError as e:
+    return skipped('no display ({:s})'.format(str(e)))
+  root.withdraw()
+  db = dirbrowser.DirBrowse(root)
+  files = library.files
+  def _fill():
+    db.virtual_flat(files)
+    root.update_idletasks()
+  try:
+    return summarize(timeit(_fill, repeats), n_items=len(files))
+  finally:
+    root.destroy()
+
+def bench_resize_image(repeats, library):
+  """Decode and shrink each photo for the preview pane (the non draft path)."""
+  def _resize(md):
+    img = Image.open(md['SourceFile'])
+    thumbnails.resize_image(img, (800, 600), md['Orientation'])
+  return summarize(time_each(_resize, library.metadata, repeats), n_items=1)
+
+def bench_export_pile(repeats, library):
+  """What resize_and_show does with the pile: export every photo to fit 640x480 on the process pool."""
+  files = [fi[0] for fi in library.files]
+  def _export():
+    out_dir = tempfile.mkdtemp()
+    try:
+      exp = exporter.PileExporter(files, out_dir, (640, 480))
+      while not exp.finished():
+        exp.poll()
+        time.sleep(0.01)
+    finally:
+      shutil.rmtree(out_dir)
+  return summarize(timeit(_export, repeats), n_items=len(files))
+
+search_queries = ["k='river'", "c='*fireworks*'", "f<4 && l>=50", "(k='rose' || k='cat') && d>$time.iso(2010-01-01)",
+                  "k='gar*'"]
+
+def bench_search(repeats, library):
+  """Queries against the local search index built from the library's metadata."""
+  fname = os.path.join(tempfile.mkdtemp(), 'search.sqlite')
+  index = searchindex.SearchIndex(fname)
+  try:
+    index.update(library.metadata)
+    return summarize(time_each(lambda q: index.search(q, library.photo_dir), search_queries, repeats), n_items=1)
+  finally:
+    index.close()
+    shutil.rmtree(os.path.dirname(fname))
+
+def bench_startup(repeats, library):
+  """How long guichhobi takes to import in a fresh interpreter and, when there is a display, how long from the start
+  of the import until the window is first painted."""
+  here = os.path.dirname(os.path.abspath(__file__))
+  def _run(args):
+    with open(os.devnull, 'w') as devnull:
+      out = subprocess.check_output([sys.executable] + args, cwd=here, stderr=devnull)
+    return json.loads(out.strip().splitlines()[-1])
+  import_code = 'import time, json; t0 = time.time(); import guichhobi; print json.dumps({"import_s": time.time() - t0})'
+  report = {'import': summarize([_run(['-c', import_code])['import_s'] for n in range(repeats)])}
+  try:
+    report['first_paint'] = summarize([_run(['guichhobi.py', '--time-startup'])['first_paint_s']
+                                       for n in range(repeats)])
+  except subprocess.CalledProcessError:
+    report['first_paint'] = skipped('could not open a window')
+  return report
+
+benchmarks = {
+  'reader_preview_10MB': bench_reader_preview,
+  'reader_json_10k_files': bench_reader_json,
+  'metadata_batch': bench_metadata_batch,
+  'metadata_single': bench_metadata_single,
+  'thumbnail': bench_thumbnail,
+  'exif_reader': bench_exif_reader,
+  'rotate': bench_rotate,
+  'list_directory': bench_list_directory,
+  'virtual_flat': bench_virtual_flat,
+  'resize_image': bench_resize_image,
+  'export_pile': bench_export_pile,
+  'search': bench_search,
+  'startup': bench_startup
+}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument('-r', default=5, type=int, help='Number of repeats per benchmark')
+  parser.add_argument('-n', default=200, type=int, help='Number of photos in the synthetic library')
+  parser.add_argument('--size', default='1600x1200', help='Size of the synthetic photos, WxH')
+  parser.add_argument('--seed', default=0, type=int, help='Seed for the synthetic library')
+  parser.add_argument('--library', help='Make (or reuse) the synthetic library here and keep it')
+  parser.add_argument('names', nargs='*', help='Benchmarks to run (default all)')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+  dirname = args.library or tempfile.mkdtemp(prefix='chhobi_bench')
+  library = SyntheticLibrary(dirname, args.n, tuple(int(x) for x in args.size.lower().split('x')), args.seed)
+  report = {}
+  try:
+    for name in args.names or sorted(benchmarks.keys()):
+      logger.info('Running {:s}'.format(name))
+      report[name] = benchmarks[name](args.r, library)
+  finally:
+    if args.library is None: shutil.rmtree(dirname)
+  print json.dumps(report, indent=2, sort_keys=True)
@@ -0,0 +1,241 @@
+"""Persistent caches that let us skip work we have already done for a file.
+
+A file is identified by its path together with its size, modification time and inode. If any of these change
+the cached entry is treated as stale, so edits made outside Chhobi are picked up without any bookkeeping.
+
+MetadataCache - the exiftool JSON for a photo, kept in a small SQLite database
+ThumbnailCache - ready to display thumbnails, in an in-memory LRU backed by an append-only pack file on disk
+"""
+import logging
+logger = logging.getLogger(__name__)
+import os, json, sqlite3, threading, struct, mmap, marshal, collections
+from cStringIO import StringIO
+from PIL import Image
+from libchhobi import to_unicode as _u
+
+def file_identity(path):
+  """Return (size, mtime, inode) for the file or None if we can't stat it."""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return st.st_size, st.st_mtime, st.st_ino
+
+class MetadataCache(object):
+  """Stores the metadata exiftool returns for each photo. The connection is shared between threads (the
+  exiftool futures resolve on whichever thread asks for the result) so all access goes through a lock."""
+  def __init__(self, fname, batch=500):
+    self.fname = fname
+    self.batch = batch #sqlite limits the number of parameters in a query
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(fname, check_same_thread=False)
+    self.db.execute('CREATE TABLE IF NOT EXISTS metadata '
+                    '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, json TEXT)')
+    self.db.commit()
+    self.hits = 0
+    self.misses = 0
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+  def get(self, paths):
+    """Return a dict mapping each path that has a fresh cache entry to its metadata."""
+    found = {}
+    paths = list(paths)
+    for n in range(0, len(paths), self.batch):
+      chunk = dict((_u(p), p) for p in paths[n:n + self.batch])
+      with self.lock:
+        rows = self.db.execute('SELECT path, size, mtime, inode, json FROM metadata WHERE path IN ({:s})'.format(
+          ','.join('?' * len(chunk))), chunk.keys()).fetchall()
+      for path, size, mtime, inode, md in rows:
+        if file_identity(path) == (size, mtime, inode):
+          found[chunk[path]] = json.loads(md)
+    self.hits += len(found)
+    self.misses += len(paths) - len(found)
+    return found
+
+  def identities(self, paths):
+    """Path -> file identity, to be taken before the metadata is read and handed to put."""
+    return dict((p, file_identity(p)) for p in paths)
+
+  def put(self, items, identities=None):
+    """items is a list of (path, metadata) pairs. identities (from identities()) are the files' identities from
+    before the metadata was read. Without them the identity is taken now, which is only safe if the file can't
+    have changed since it was read."""
+    rows = []
+    for path, md in items:
+      ident = identities[path] if identities is not None and path in identities else file_identity(path)
+      if ident is None: continue
+      rows.append((_u(path),) + ident + (json.dumps(md),))
+    with self.lock:
+      self.db.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)', rows)
+      self.db.commit()
+
+  def invalidate(self, paths):
+    with self.lock:
+      self.db.executemany('DELETE FROM metadata WHERE path = ?', [(_u(p),) for p in paths])
+      self.db.commit()
+
+
+class LRUCache(object):
+  """A dict with a byte budget. The least recently used entries are evicted once the budget is exceeded."""
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.n_bytes = 0
+    self.entries = collections.OrderedDict() #key -> (value, n_bytes)
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return None
+      self.entries[key] = entry #Move to the most recently used end
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value, n_bytes):
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old is not None: self.n_bytes -= old[1]
+      self.entries[key] = (value, n_bytes)
+      self.n_bytes += n_bytes
+      while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+        _, (_, nb) = self.entries.popitem(last=False)
+        self.n_bytes -= nb
+
+class ThumbnailPack(object):
+  """An append-only file of encoded thumbnails. Each record is
+    <key length><data length> (two little endian uint32) <key> <data>
+  A thumbnail that is stored again simply shadows the older record. Reads go through a memory map of the file and
+  hand back buffer objects, so nothing is copied.
+
+  The offset index is saved next to the pack (fname.idx) on close, along with the length of the pack it covers.
+  When the pack is opened the saved index is loaded and only the records after that length (written by a run that
+  didn't close cleanly) are read, so start-up doesn't depend on how many thumbnails there are. If the pack is
+  shorter than the saved length, or is a different file, the index is rebuilt from the record headers."""
+  header = struct.Struct('<II')
+  index_version = 1
+
+  def __init__(self, fname):
+    self.fname = fname
+    self.index_fname = fname + '.idx'
+    self.lock = threading.Lock()
+    self.index = {} #key -> (offset, length)
+    self.fp = open(fname, 'a+b')
+    self.mm = None
+    self.end = self.build_index(self.load_index())
+    if self.end < os.path.getsize(fname): #Crashed mid-write. Cut off the partial record
+      self.fp.truncate(self.end)
+
+  def close(self):
+    with self.lock:
+      self.save_index()
+      self.fp.close()
+      self.mm = None
+
+  def load_index(self):
+    """Load the saved index and return the offset it is good up to (0 if there is nothing usable)."""
+    try:
+      with open(self.index_fname, 'rb') as f:
+        version, inode, end, index = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+      return 0
+    st = os.fstat(self.fp.fileno())
+    if version != self.index_version or inode != st.st_ino or end > st.st_size: return 0
+    self.index = index
+    return end
+
+  def save_index(self):
+    tmp = self.index_fname + '.tmp'
+    try:
+      with open(tmp, 'wb') as f:
+        marshal.dump((self.index_version, os.fstat(self.fp.fileno()).st_ino, self.end, self.index), f)
+      os.rename(tmp, self.index_fname)
+    except (IOError, OSError) as e:
+      logger.warning('Could not save the thumbnail index: {:s}'.format(str(e)))
+
+  def build_index(self, offset=0):
+    """Add the records from offset on to the index. Returns the end of the last complete record."""
+    size = os.fstat(self.fp.fileno()).st_size
+    self.fp.seek(offset)
+    while True:
+      hdr = self.fp.read(self.header.size)
+      if len(hdr) < self.header.size: break
+      key_len, data_len = self.header.unpack(hdr)
+      key = self.fp.read(key_len)
+      if len(key) < key_len: break
+      data_offset = offset + self.header.size + key_len
+      if data_offset + data_len > size: break #Seeking past the end doesn't fail, so check against the size
+      self.fp.seek(data_len, 1)
+      self.index[key] = (data_offset, data_len)
+      offset = data_offset + data_len
+    return offset
+
+  def get(self, key):
+    with self.lock:
+      loc = self.index.get(key)
+      if loc is None: return None
+      offset, length = loc
+      if self.mm is None or len(self.mm) < offset + length:
+        #Don't close the old map - buffers handed out earlier may still point into it
+        self.mm = mmap.mmap(self.fp.fileno(), self.end, access=mmap.ACCESS_READ)
+      return buffer(self.mm, offset, length)
+
+  def put(self, key, data):
+    with self.lock:
+      self.fp.seek(self.end)
+      self.fp.write(self.header.pack(len(key), len(data)) + key)
+      self.fp.write(data)
+      self.fp.flush()
+      self.index[key] = (self.end + self.header.size + len(key), len(data))
+      self.end += self.header.size + len(key) + len(data)
+
+class ThumbnailCache(object):
+  """Two levels of thumbnail cache: decoded, oriented and resized PIL images in an LRU with a byte budget, and
+  JPEG encoded copies of the same in a ThumbnailPack so they survive restarts. Keys are file identities, so
+  a thumbnail is regenerated when the file changes."""
+  def __init__(self, fname, max_bytes=64 * 1024 * 1024):
+    self.memory = LRUCache(max_bytes)
+    self.pack = ThumbnailPack(fname)
+
+  def close(self):
+    self.pack.close()
+
+  def key(self, path):
+    ident = file_identity(path)
+    if ident is None: return None
+    return json.dumps([_u(path)] + list(ident)).encode('utf-8')
+
+  def has(self, path):
+    """True if there is an up to date thumbnail for this file. Nothing is decoded."""
+    key = self.key(path)
+    return key is not None and key in self.pack.index
+
+  def get(self, path):
+    """Return the PIL image for this file, or None if we have never made one."""
+    key = self.key(path)
+    if key is None: return None
+    img = self.memory.get(key)
+    if img is not None: return img
+    data = self.pack.get(key)
+    if data is None: return None
+    img = Image.open(StringIO(data))
+    img.load()
+    self.memory.put(key, img, img.size[0] * img.size[1] * len(img.getbands()))
+    return img
+
+  def put(self, path, img):
+    key = self.key(path)
+    if key is None: return
+    out = StringIO()
+    img.convert('RGB').save(out, 'JPEG', quality=90)
+    self.pack.put(key, out.getvalue())
+    self.memory.put(key, img, img.size[0] * img.size[1] * len(img.getbands()))
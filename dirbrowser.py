@@ -2,7 +2,35 @@
 http://stackoverflow.com/questions/14404982/python-gui-tree-walk
 By mmgp (http://stackoverflow.com/users/1832154/mmgp)
 """
-import os, Tkinter as tki, ttk
+import logging
+logger = logging.getLogger(__name__)
+import os, threading, Queue, Tkinter as tki, ttk
+import libchhobi as lch, stats
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir #https://pypi.python.org/pypi/scandir
+  except ImportError:
+    scandir = None
+
+def list_directory(path, ext_map=lch.default_ext_map):
+  """Yield (name, fullpath, ptype) for the directories, photos and videos in path. With scandir the directory test
+  comes from the d_type the OS hands back, so there is no stat per entry. Without it we only stat names that don't
+  already look like a photo or video."""
+  if scandir is not None:
+    for entry in scandir(path):
+      if entry.is_dir():
+        yield entry.name, entry.path, 'directory'
+      else:
+        ptype = lch.media_type(entry.name, ext_map)
+        if ptype is not None: yield entry.name, entry.path, ptype
+  else:
+    for name in os.listdir(path):
+      p = os.path.join(path, name)
+      ptype = lch.media_type(name, ext_map)
+      if ptype is None and os.path.isdir(p): ptype = 'directory'
+      if ptype is not None: yield name, p, ptype
 
 class DirBrowse(tki.Frame):
   """The item data consist of fullpath and type.
@@ -11,23 +39,50 @@ class DirBrowse(tki.Frame):
    * The root of a virtual listing which has a ptype = 'back to root' and
    * Dummy leaves which have not been opened yet (required to show the expanding arrow) which have a
      ptype = 'dummy'
+
+  Directories are listed on a background thread and the rows are put into the tree in batches from the Tk thread,
+  so opening a huge folder doesn't lock up the UI. Listings are cached and reused while the directory's mtime is
+  unchanged.
+
+  Virtual listings (search results, the pile) can be huge, so they are not put into the treeview wholesale. The
+  paths are kept in a plain list and only a window of window_size rows around what is on screen is turned into
+  treeview items. The scrollbar is driven by us and shows the position in the whole list. As the view nears the
+  edge of the window we move the window. Selected rows that scroll out of the window are remembered so
+  file_selection still sees them.
   """
   def __init__(self, parent, dir_root=None,
-               photo_ext=['jpg', 'tiff', 'gif', 'png', 'raw', 'nef'],
-               video_ext = ['avi', 'mov', 'm4v', 'mkv'],
+               photo_ext=lch.photo_ext,
+               video_ext=lch.video_ext,
+               window_size=300,
+               batch_size=500,
                **options):
     tki.Frame.__init__(self, parent)
     self.photo_ext = photo_ext
     self.video_ext = video_ext
+    self.ext_map = lch.ext_type_map(photo_ext, video_ext)
+    self.batch_size = batch_size
+    self.listing_cache = {} #path -> (mtime, [(name, fullpath, ptype), ...])
+    self.listing_jobs = {} #node -> token of the listing currently filling it
+    self.window_size = window_size
+    self.virtual_rows = None #For a virtual listing, the title followed by the paths
+    self.virtual_types = {} #path -> ptype for rows we have looked at
+    self.virtual_selection = set() #Selected paths that are outside the materialized window
+    self.window_start = 0
+    self.recenter_pending = False
     style = ttk.Style()
     style.map("my.Treeview",
       foreground=[('selected', 'yellow'), ('active', 'white')],
       background=[('selected', 'black'), ('active', 'black')]
     )
-    self.treeview = ttk.Treeview(self, columns=("fullpath", "type"),show='tree',displaycolumns=(), style='my.Treeview')
+    self.scrollbar = ttk.Scrollbar(self, orient='vertical', command=self.yview)
+    self.scrollbar.pack(side='right', fill='y')
+    self.treeview = ttk.Treeview(self, columns=("fullpath", "type"),show='tree',displaycolumns=(), style='my.Treeview',
+                                 yscrollcommand=self.yscroll)
     self.treeview.pack(expand=True, fill='both')
     if dir_root is not None: self.set_dir_root(dir_root)
     self.treeview.bind('<<TreeviewOpen>>', self.update_tree)
+    self.treeview.bind('<Button-1>', self.forget_hidden_selection, add='+')
+    self.treeview.bind('<Key>', self.forget_hidden_selection, add='+')
 
   def set_initial_focus(self):
     tv = self.treeview
@@ -36,6 +91,8 @@ class DirBrowse(tki.Frame):
     tv.selection_set(node)
 
   def set_dir_root(self, startpath):
+    self.virtual_rows = None
+    self.listing_jobs = {}
     map(self.treeview.delete, self.treeview.get_children()) #Delete the original
     self.start_path = startpath
     dfpath = os.path.abspath(startpath)
@@ -45,20 +102,10 @@ class DirBrowse(tki.Frame):
     self.set_initial_focus()
 
   def file_type(self, p):
-    ptype = None
-    if os.path.isdir(p):
+    """Extension lookup first, so photos and videos don't cost a stat."""
+    ptype = lch.media_type(p, self.ext_map)
+    if ptype is None and os.path.isdir(p):
       ptype = 'directory'
-    else: #We are a regular file
-      P = p.lower()
-      for ext in self.photo_ext:
-        if P.endswith(ext):
-          ptype = 'file:photo'
-          break
-      if ptype is None:
-        for ext in self.video_ext:
-          if P.endswith(ext):
-            ptype = 'file:video'
-            break
     return ptype
 
   def fill_tree(self, node):
@@ -66,38 +113,182 @@ class DirBrowse(tki.Frame):
       return
     path = self.treeview.set(node, "fullpath")
     self.treeview.delete(*self.treeview.get_children(node)) # Delete the possibly 'dummy' node present.
-    for p in os.listdir(path):
-      p = os.path.join(path, p)
-      ptype = self.file_type(p)
-      if ptype is None: continue
-      fname = os.path.split(p)[1]
-      oid = self.treeview.insert(node, 'end', text=fname, values=[p, ptype], iid=p)
-      if ptype == 'directory':
-        self.treeview.insert(oid, 0, text='dummy', values=['dummy', 'dummy'])
+    try:
+      mtime = os.stat(path).st_mtime
+    except OSError:
+      return
+    token = object()
+    self.listing_jobs[node] = token
+    results = Queue.Queue()
+    cached = self.listing_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+      for n in range(0, len(cached[1]), self.batch_size):
+        results.put(cached[1][n:n + self.batch_size])
+      results.put(None)
+    else:
+      lister = threading.Thread(target=self.list_in_background, args=(path, mtime, results), name='lister')
+      lister.daemon = True
+      lister.start()
+    self.poll_listing(node, results, token)
+
+  def list_in_background(self, path, mtime, results):
+    entries, batch = [], []
+    try:
+      for entry in list_directory(path, self.ext_map):
+        batch.append(entry)
+        if len(batch) >= self.batch_size:
+          results.put(batch)
+          entries += batch
+          batch = []
+    except OSError as e:
+      logger.error(e)
+      entries = None #Only part of the listing. Don't keep it
+    results.put(batch)
+    results.put(None)
+    if entries is not None: self.listing_cache[path] = (mtime, entries + batch)
+
+  def poll_listing(self, node, results, token):
+    """Runs on the Tk thread, putting one batch of rows into the tree per call."""
+    if self.listing_jobs.get(node) is not token or not self.treeview.exists(node):
+      return #The tree was reset or the node was refilled since we started
+    while True:
+      try:
+        batch = results.get_nowait()
+      except Queue.Empty:
+        break
+      if batch is None:
+        del self.listing_jobs[node]
+        return
+      with stats.timed('treeview batch'):
+        for fname, p, ptype in batch:
+          oid = self.treeview.insert(node, 'end', text=fname, values=[p, ptype], iid=p)
+          if ptype == 'directory':
+            self.treeview.insert(oid, 0, text='dummy', values=['dummy', 'dummy'])
+      stats.count('treeview rows', len(batch))
+      break #Let Tk breathe between batches
+    self.after(10, self.poll_listing, node, results, token)
 
   def virtual_flat(self, files, title='Virtual listing'):
     # Set the contents to a flat listing of files. Useful for 'virtual' folders we create on the fly
-    self.treeview.delete(*self.treeview.get_children())#Delete the original
-    ins = self.treeview.insert
-    #Special first node, instructs us to go back to the real listing
-    ptype = 'title'
-    ins('','end', text=title, values=['title', ptype])
-    for file in files:
-      ptype = self.file_type(file)
-      #fname = os.path.split(file)[1]
-      ins('','end', text=file, values=[file, ptype], iid=file)
+    self.virtual_rows = [title] + list(files) #Special first node, instructs us to go back to the real listing
+    self.virtual_types = {}
+    self.virtual_selection = set()
+    self.materialize(0)
     self.set_initial_focus()
 
+  def virtual_append(self, files):
+    """Add more files to the end of a virtual listing, for results that come in a bit at a time."""
+    self.virtual_rows.extend(files)
+    n_shown = len(self.treeview.get_children())
+    for idx in range(self.window_start + n_shown, min(self.window_start + self.window_size, len(self.virtual_rows))):
+      self.insert_virtual_row(idx)
+    self.yscroll(*self.treeview.yview())
+
+  def virtual_type(self, path):
+    if path not in self.virtual_types:
+      self.virtual_types[path] = self.file_type(path)
+    return self.virtual_types[path]
+
+  def insert_virtual_row(self, idx):
+    if idx == 0:
+      ptype = 'title'
+      self.treeview.insert('','end', text=self.virtual_rows[0], values=['title', ptype])
+      return
+    file = self.virtual_rows[idx]
+    if self.treeview.exists(file): return #Duplicate in the listing
+    ptype = self.virtual_type(file)
+    #fname = os.path.split(file)[1]
+    self.treeview.insert('','end', text=file, values=[file, ptype], iid=file)
+
+  def materialize(self, top_row):
+    """Rebuild the window of treeview items so that it is centered on row top_row of the virtual listing, keeping
+    the selection and focus, and scroll so top_row is at the top of the view."""
+    with stats.timed('treeview window'):
+      self._materialize(top_row)
+
+  def _materialize(self, top_row):
+    tv = self.treeview
+    shown = tv.get_children()
+    selected = set(tv.selection())
+    self.virtual_selection = (self.virtual_selection - set(shown)) | selected
+    focus = tv.focus()
+    start = max(0, min(top_row - self.window_size // 2, len(self.virtual_rows) - self.window_size))
+    self.window_start = start
+    tv.delete(*shown)
+    for idx in range(start, min(start + self.window_size, len(self.virtual_rows))):
+      self.insert_virtual_row(idx)
+    shown = tv.get_children()
+    reselect = [iid for iid in shown if iid in self.virtual_selection]
+    if len(reselect): tv.selection_set(reselect)
+    if focus and tv.exists(focus): tv.focus(focus)
+    if len(shown): tv.yview_moveto(float(top_row - start) / len(shown))
+
+  def forget_hidden_selection(self, event):
+    """A click or key press without Shift/Control/Command replaces the selection, so the remembered selection
+    outside the window has to go too."""
+    if not event.state & (0x0001 | 0x0004 | 0x0008): #Shift, Control, Mod1 (Command on the Mac)
+      self.virtual_selection = set()
+
+  def yview(self, *args):
+    """Scrollbar command. Dragging in a virtual listing can go anywhere in the list, so we move the window there."""
+    if self.virtual_rows is not None and args[0] == 'moveto':
+      self.materialize(int(float(args[1]) * len(self.virtual_rows)))
+    else:
+      self.treeview.yview(*args)
+
+  def yscroll(self, first, last):
+    """The treeview's yscrollcommand. In a virtual listing the fractions are relative to the window, so we convert
+    them to the whole list and move the window when the view gets close to its edge."""
+    if self.virtual_rows is None:
+      self.scrollbar.set(first, last)
+      return
+    n_shown, total = len(self.treeview.get_children()), len(self.virtual_rows)
+    top, bottom = float(first) * n_shown, float(last) * n_shown
+    if total: self.scrollbar.set((self.window_start + top) / total, (self.window_start + bottom) / total)
+    margin = self.window_size // 4
+    near_top = top < margin and self.window_start > 0
+    near_bottom = n_shown - bottom < margin and self.window_start + n_shown < total
+    if (near_top or near_bottom) and not self.recenter_pending:
+      self.recenter_pending = True
+      self.after_idle(self.recenter, self.window_start + int(top))
+
+  def recenter(self, top_row):
+    self.recenter_pending = False
+    if self.virtual_rows is not None: self.materialize(top_row)
+
+  def neighbours(self, k=10):
+    """Return the file rows currently on screen and the k rows either side of the focused one, nearest first.
+    Used to decide what to prefetch."""
+    tv = self.treeview
+    focus = tv.focus()
+    if not focus: return []
+    siblings = tv.get_children(tv.parent(focus))
+    idx = siblings.index(focus)
+    items = []
+    for n in range(1, k + 1):
+      for j in [idx + n, idx - n]:
+        if 0 <= j < len(siblings): items.append(siblings[j])
+    item = tv.identify_row(1)
+    while item and tv.bbox(item): #Walk down the visible rows
+      if item not in items: items.append(item)
+      item = tv.next(item)
+    return [tv.item(it)['values'] for it in items if tv.set(it, 'type')[:4] == 'file']
+
   def update_tree(self, event):
     self.fill_tree(self.treeview.focus())
 
-  def file_selection(self):
+  def selection_values(self):
+    """[fullpath, type] for every selected row, including rows of a virtual listing outside the window."""
     tv = self.treeview
-    files = self.treeview.selection()
-    return [tv.item(fi)['values'] for fi in files if tv.item(fi)['values'][1][:4]=='file']
+    values = [tv.item(fi)['values'] for fi in tv.selection()]
+    if self.virtual_rows is not None:
+      shown = set(tv.get_children())
+      values += [[f, self.virtual_type(f) or ''] for f in self.virtual_selection if f not in shown]
+    return values
+
+  def file_selection(self):
+    return [v for v in self.selection_values() if v[1][:4]=='file']
 
   def all_selection(self):
     #from IPython import embed; embed()
-    tv = self.treeview
-    files = self.treeview.selection()
-    return [tv.item(fi)['values'] for fi in files if (tv.item(fi)['values'][1]=='directory') or (tv.item(fi)['values'][1][:4]=='file')] #Only exclude the virtual listing head
\ No newline at end of file
+    return [v for v in self.selection_values() if (v[1]=='directory') or (v[1][:4]=='file')] #Only exclude the virtual listing head
\ No newline at end of file
@@ -0,0 +1,125 @@
+"""Reads the orientation and the embedded thumbnail straight out of a photo, without a round trip to exiftool.
+
+  info = exifreader.read_exif(fname)
+  if info is not None: info.orientation, info.thumbnail
+
+The file is memory mapped and only the pages holding the headers (and the thumbnail) are ever read. We handle
+JPEGs with an Exif APP1 segment and TIFF based files (TIFF, NEF and most other raw formats): the IFD0 chain and any
+SubIFDs are walked and the smallest embedded JPEG found is taken as the thumbnail. info.thumbnail is a buffer onto
+the mapping, so nothing is copied until PIL decodes it (it is None if there is no embedded JPEG). read_exif returns
+None for anything else (PNGs, damaged headers) and get_thumbnail_image then asks exiftool, as before. The thumbnail
+pane and rotation take the orientation from here too (see read_thumbnail and PersistentExifTool.get_orientations).
+"""
+import logging
+logger = logging.getLogger(__name__)
+import mmap, struct
+import stats
+
+ORIENTATION = 0x0112
+SUB_IFDS = 0x014a
+JPEG_OFFSET = 0x0201
+JPEG_LENGTH = 0x0202
+max_ifds = 16 #Guards against IFD chains that loop or run off into garbage
+max_entries = 1000
+
+class ExifInfo(object):
+  def __init__(self, orientation=None, thumbnail=None):
+    self.orientation = orientation
+    self.thumbnail = thumbnail
+
+class ReadyFuture(object):
+  """Stands in for an ExifFuture when we already have the answer."""
+  def __init__(self, value):
+    self.value = value
+
+  def done(self):
+    return True
+
+  def result(self, timeout=None):
+    return self.value
+
+def read_exif(fname):
+  """Return an ExifInfo for fname, or None if we can't read it here and exiftool should be asked instead."""
+  try:
+    with open(fname, 'rb') as f:
+      mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) #The mapping outlives the file object
+  except (EnvironmentError, ValueError): #ValueError: empty file
+    return None
+  try:
+    if mm[:2] == '\xff\xd8':
+      base = jpeg_exif_offset(mm)
+    elif mm[:4] in ('II*\0', 'MM\0*'):
+      base = 0
+    else:
+      base = None
+    if base is None: return None
+    return parse_tiff(mm, base)
+  except (struct.error, IndexError, ValueError) as e:
+    logger.debug('Could not parse EXIF of {:s}: {:s}'.format(fname, str(e)))
+    return None
+
+def jpeg_exif_offset(mm):
+  """Offset of the TIFF header inside the Exif APP1 segment, or None if there isn't one before the image data."""
+  pos = 2
+  while pos + 4 <= len(mm):
+    fill, marker, length = struct.unpack_from('>BBH', mm, pos)
+    if fill != 0xff: return None
+    if marker == 0xff: #Padding
+      pos += 1
+      continue
+    if marker in (0xda, 0xd9): return None #Start of scan, end of image
+    if marker == 0xe1 and mm[pos + 4:pos + 10] == 'Exif\0\0': return pos + 10
+    pos += 2 + length
+  return None
+
+def parse_tiff(mm, base):
+  """Walk the IFDs of the TIFF block at base. Offsets inside it are relative to base."""
+  order = {'II': '<', 'MM': '>'}.get(mm[base:base + 2])
+  if order is None: raise ValueError('Bad byte order mark')
+  def _unpack(fmt, offset):
+    return struct.unpack_from(order + fmt, mm, base + offset)
+  def _value(entry): #A SHORT or LONG held in the entry itself
+    return _unpack('H' if entry[0] == 3 else 'I', entry[2])[0]
+  info = ExifInfo()
+  jpegs = []
+  to_visit, seen = [_unpack('I', 4)[0]], set()
+  while len(to_visit) and len(seen) < max_ifds:
+    offset = to_visit.pop(0)
+    if offset == 0 or offset in seen: continue
+    seen.add(offset)
+    n_entries = _unpack('H', offset)[0]
+    if n_entries > max_entries: raise ValueError('IFD at {:d} has {:d} entries'.format(offset, n_entries))
+    tags = {}
+    for k in range(n_entries):
+      tag, typ, count = _unpack('HHI', offset + 2 + 12 * k)
+      tags[tag] = (typ, count, offset + 2 + 12 * k + 8)
+    if ORIENTATION in tags and len(seen) == 1: #Only IFD0 describes the main image
+      info.orientation = _unpack('H', tags[ORIENTATION][2])[0]
+    if SUB_IFDS in tags:
+      typ, count, pos = tags[SUB_IFDS]
+      if count > 1: pos = _unpack('I', pos)[0]
+      to_visit += [_unpack('I', pos + 4 * n)[0] for n in range(min(count, max_ifds))]
+    if JPEG_OFFSET in tags and JPEG_LENGTH in tags:
+      start, length = _value(tags[JPEG_OFFSET]), _value(tags[JPEG_LENGTH])
+      if length and base + start + length <= len(mm) and mm[base + start:base + start + 2] == '\xff\xd8':
+        jpegs.append((length, base + start))
+    to_visit.append(_unpack('I', offset + 2 + 12 * n_entries)[0]) #Next IFD in the chain
+  if len(jpegs):
+    length, start = min(jpegs) #The smallest is the quickest to decode
+    info.thumbnail = buffer(mm, start, length)
+  return info
+
+def read_thumbnail(etool, file, block=True):
+  """Return (thumbnail, orientation) for the file. The thumbnail is read straight from the file when we can and
+  from etool.get_thumbnail_image otherwise (an ExifFuture if block is False). The orientation is None if we could
+  not read the file's EXIF here."""
+  with stats.timed('exif reader'):
+    info = read_exif(file)
+  if info is None or info.thumbnail is None:
+    stats.count('exif reader fallback')
+    return etool.get_thumbnail_image(file, block), info.orientation if info is not None else None
+  return info.thumbnail if block else ReadyFuture(info.thumbnail), info.orientation
+
+def get_thumbnail_image(etool, file, block=True):
+  """Same as etool.get_thumbnail_image, but read straight from the file when we can."""
+  return read_thumbnail(etool, file, block)[0]
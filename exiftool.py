@@ -22,10 +22,134 @@ http://stackoverflow.com/questions/8530825/mac-os-x-add-a-custom-meta-data-field
 """
 import logging
 logger = logging.getLogger(__name__)
-import os, subprocess, json, libchhobi as lch
+import os, time, subprocess, json, threading, multiprocessing, libchhobi as lch, stats, exifreader
+
+def by_source_file(file_list, meta_data):
+  """Pair up the files (paths) with their metadata. exiftool leaves out files it can't read, so we go by SourceFile
+  rather than by position. Returns (path, metadata) pairs in the order of file_list, without the files that didn't
+  come back."""
+  found = dict((lch.to_unicode(md['SourceFile']), md) for md in meta_data if 'SourceFile' in md)
+  return [(f, found[lch.to_unicode(f)]) for f in file_list if lch.to_unicode(f) in found]
+
+class ExifToolError(Exception):
+  """Raised on a pending query when the exiftool process goes away before answering it."""
+  pass
+
+#Orientation after rotating, keyed by the original. See PersistentExifTool.rotate_images
+rotate_dict = {
+  'cw': {
+    1: 6,
+    6: 3,
+    3: 8,
+    8: 1
+  },
+  'ccw': {
+    1: 8,
+    8: 3,
+    3: 6,
+    6: 1
+  }
+}
+
+class ResponseBuffer(object):
+  """Collects exiftool's stdout and cuts it into responses. Chunks are appended to a growable bytearray and the
+  sentinel search only looks at bytes it has not already scanned, so reading an n byte response costs O(n) rather
+  than the O(n^2) of repeatedly concatenating strings."""
+  def __init__(self):
+    self.buf = bytearray()
+    self.scan_from = 0
+
+  def feed(self, chunk):
+    self.buf += chunk
+
+  def pop(self, tag):
+    """Return the response (as a bytearray, without the sentinel) for this tag if it is complete, else None."""
+    sentinel = b'{ready%d}' % tag
+    idx = self.buf.find(sentinel, self.scan_from)
+    if idx < 0:
+      #The sentinel may be split across chunks, so back up a little for the next search
+      self.scan_from = max(len(self.buf) - len(sentinel) + 1, 0)
+      return None
+    response = self.buf[:idx] #The one copy we make
+    end = idx + len(sentinel)
+    if self.buf[end:end + 1] == b'\n': end += 1
+    del self.buf[:end]
+    self.scan_from = 0
+    return response
+
+class ExifFuture(object):
+  """Stands in for the answer to a query that has been sent to exiftool but may not have come back yet.
+  result() blocks until the reader thread hands us the raw output."""
+  def __init__(self, expecting_response=True, expecting_binary=False, then=None):
+    self.expecting_response = expecting_response
+    self.expecting_binary = expecting_binary
+    self.then = then #If given, applied to the parsed response before it is handed back
+    self.submitted = time.time()
+    self._done = threading.Event()
+    self._lock = threading.Lock()
+    self._finished = False
+    self._callbacks = []
+    self._output = None
+    self._error = None
+
+  def set_output(self, output):
+    stats.record('exiftool', time.time() - self.submitted, len(output)) #Includes any wait behind earlier queries
+    self._output = output
+    self._finish()
+
+  def set_error(self, error):
+    self._error = error
+    self._finish()
+
+  def _finish(self):
+    """The callbacks run before result() is released, so whoever waits on us sees their effects."""
+    with self._lock:
+      self._finished = True
+      callbacks, self._callbacks = self._callbacks, []
+    for func in callbacks:
+      try:
+        func(self)
+      except Exception:
+        logger.exception('In exiftool callback')
+    self._done.set()
+
+  def add_done_callback(self, func):
+    """func(future) is called on the reader thread once exiftool has answered, or right away if it already has.
+    Unlike then, it runs whether or not anyone asks for the result."""
+    with self._lock:
+      if not self._finished:
+        self._callbacks.append(func)
+        return
+    func(self)
+
+  def done(self):
+    return self._done.is_set()
+
+  def result(self, timeout=None):
+    if not self._done.wait(timeout):
+      return None
+    if self._error is not None:
+      raise self._error
+    if not self.expecting_response:
+      result = None
+    elif self.expecting_binary:
+      result = self._output
+    else:
+      logger.debug(self._output)
+      stripped = self._output.strip()
+      if len(stripped):
+        result = json.loads(stripped.decode("utf-8"))
+      else:
+        result = []
+    if self.then is not None:
+      result = self.then(result)
+    return result
 
 class PersistentExifTool(object):
-  """A class that simply opens exiftool with the -stay_open 1 flag and sets up communication via stdin."""
+  """A class that simply opens exiftool with the -stay_open 1 flag and sets up communication via stdin.
+  Queries are pipelined: each one is terminated by a numbered -execute<N> and exiftool answers with a matching
+  {ready<N>}. A reader thread matches the answers to the waiting futures, so several queries can be in flight on
+  the one process at the same time."""
   def __init__(self):
     with open(os.devnull, 'w') as devnull:
       self.exiftool_process = subprocess.Popen(
@@ -33,38 +157,71 @@ class PersistentExifTool(object):
         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
         stderr=devnull)
     self.running = True
+    self.write_lock = threading.Lock() #Serializes writes to exiftool's stdin
+    self.pending_lock = threading.Lock() #Guards the pending dict, shared with the reader thread
+    self.last_tag = 0
+    self.pending = {} #tag -> ExifFuture
+    self.reader_thread = threading.Thread(target=self.read_responses, name='exiftool reader')
+    self.reader_thread.daemon = True
+    self.reader_thread.start()
 
   def close(self):
-    if not self.running:
-      return
+    with self.write_lock:
+      if not self.running:
+        return
+      self.running = False
     input = b'-stay_open\nFalse\n'
-    self.exiftool_process.communicate(input)
-    self.running = False
+    self.exiftool_process.stdin.write(input)
+    self.exiftool_process.stdin.close()
+    self.exiftool_process.wait()
+    self.reader_thread.join()
 
-  def execute(self, query, expecting_response=True, expecting_binary=False):
-    """Query is a list of exiftool commands. We add the -execute in the end."""
-    query += '\n-execute\n'
-    logger.debug(query)
-    self.exiftool_process.stdin.write(query)
-    self.exiftool_process.stdin.flush()
-    output = b''
+  def read_responses(self):
+    """Runs on the reader thread. exiftool answers queries in the order they were sent, so we only ever need to
+    look for the sentinel of the oldest outstanding tag."""
     fd = self.exiftool_process.stdout.fileno()
-    response_end = b'{ready}'
-    while not output[-32:].strip().endswith(response_end):
-      output += os.read(fd, 4096)
-    if expecting_response:
-      if expecting_binary:
-        return output.rstrip()[:-len(response_end)]
-      else:
-        logging.debug(output)
-        stripped = output.strip()[:-len(response_end)]
-        if len(stripped):
-          return json.loads(stripped.decode("utf-8"))
-        else:
-          return []
-
-  def get_metadata_for_files(self, file_list, side_car_ext = '.chhobi_movie_sidecar'):
-    """Get standard metadata from the files. movie_exts are extensions that indicate file is a movie"""
+    responses = ResponseBuffer()
+    tag = 1
+    while True:
+      response = responses.pop(tag)
+      if response is not None:
+        with self.pending_lock:
+          future = self.pending.pop(tag)
+        future.set_output(response)
+        tag += 1
+        continue
+      chunk = os.read(fd, 65536)
+      if not chunk: #exiftool went away
+        break
+      responses.feed(chunk)
+    with self.pending_lock:
+      orphans, self.pending = self.pending.values(), {}
+    for future in orphans:
+      future.set_error(ExifToolError('exiftool exited before answering the query'))
+
+  def submit(self, query, expecting_response=True, expecting_binary=False, then=None):
+    """Query is a list of exiftool commands. We add the -execute<N> in the end and return an ExifFuture
+    immediately, without waiting for exiftool to answer."""
+    future = ExifFuture(expecting_response, expecting_binary, then)
+    with self.write_lock:
+      if not self.running:
+        raise ExifToolError('exiftool has been closed')
+      self.last_tag += 1
+      with self.pending_lock:
+        self.pending[self.last_tag] = future
+      query += '\n-execute{:d}\n'.format(self.last_tag)
+      logger.debug(query)
+      self.exiftool_process.stdin.write(query)
+      self.exiftool_process.stdin.flush()
+    return future
+
+  def execute(self, query, expecting_response=True, expecting_binary=False):
+    """Query is a list of exiftool commands. Blocks until exiftool has answered."""
+    return self.submit(query, expecting_response, expecting_binary).result()
+
+  def get_metadata_for_files(self, file_list, side_car_ext = '.chhobi_movie_sidecar', block=True):
+    """Get standard metadata from the files. movie_exts are extensions that indicate file is a movie
+    If block is False we return an ExifFuture instead of the metadata."""
     photo_files = [fi[0] for fi in file_list if fi[1]=='file:photo']
     video_files = [fi[0] for fi in file_list if fi[1]=='file:video']
     exiv_tags = ['-FileType', '-CreateDate', '-model', '-lensid', '-focallength', '-Dof', '-ISO', '-ShutterSpeed', '-fnumber','-Duration', '-Caption-Abstract', '-keywords', '-Orientation#'] #Hash symbol gives us number
@@ -73,18 +230,21 @@ class PersistentExifTool(object):
     for file in photo_files:
       query += file + '\n'
     query += base_query + '\n'
-    meta_data = self.execute(query)
-    meta_data += lch.read_xattr_metadata(video_files)
-    #Singleton keywords need to be converted into a list
-    for md in meta_data:
-      if md.has_key('Keywords'):
-        if not isinstance(md['Keywords'], list):
-          md['Keywords'] = [md['Keywords']]
-    return meta_data
-
-  def set_metadata_for_files(self, file_list, meta_data):
+    def _merge(meta_data):
+      meta_data = [md for f, md in by_source_file(photo_files, meta_data)] + lch.read_xattr_metadata(video_files)
+      #Singleton keywords need to be converted into a list
+      for md in meta_data:
+        if md.has_key('Keywords'):
+          if not isinstance(md['Keywords'], list):
+            md['Keywords'] = [md['Keywords']]
+      return meta_data
+    future = self.submit(query, then=_merge)
+    return future.result() if block else future
+
+  def set_metadata_for_files(self, file_list, meta_data, block=True):
     """Set selected metadata for the files. If keywords are present they are passed in as a list of tuples
      containing a plus or minus sign indicating if the keyword are to be added or removed and the keyword itself.
+    If block is False we return an ExifFuture that is done when exiftool has finished writing.
     """
     photo_files = [fi[0] for fi in file_list if fi[1]=='file:photo']
     video_files = [fi[0] for fi in file_list if fi[1]=='file:video']
@@ -96,10 +256,30 @@ class PersistentExifTool(object):
     if meta_data.has_key('keywords'):
       for keyword in meta_data['keywords']:
         query += '-keywords{:s}={:s}\n'.format(keyword[0],keyword[1])
-    self.execute(query, expecting_response=False)
+    future = self.submit(query, expecting_response=False)
     lch.write_xattr_metadata(video_files, meta_data)
+    return future.result() if block else future
+
+  def get_orientations(self, file_list):
+    """The (numeric) orientation of each photo, as a dict of file name -> orientation. It is read straight from the
+    file (exifreader) where possible, and only the rest are asked of exiftool. Files without the tag count as 1 and
+    files neither could read are left out."""
+    orientations, rest = {}, []
+    for fi in file_list:
+      info = exifreader.read_exif(fi[0])
+      if info is not None:
+        orientations[fi[0]] = info.orientation or 1
+      else:
+        rest.append(fi)
+    if not len(rest): return orientations
+    query = '-j\n-Orientation#\n'
+    for fi in rest:
+      query += fi[0] + '\n'
+    orientations.update((f, md.get('Orientation', 1)) for f, md in by_source_file([fi[0] for fi in rest],
+                                                                                  self.execute(query)))
+    return orientations
 
-  def rotate_images(self, file_list, dir):
+  def rotate_images(self, file_list, dir, orientations=None, progress=None, batch=100, block=True):
     """Rotation gets its own function because we need to set the orientation value based on the original value for
     each image, and do this separately.
     Rotating image (from the nice diagram at http://sylvana.net/jpegcrop/exif_orientation.html
@@ -112,36 +292,189 @@ class PersistentExifTool(object):
       1 -> 8
       8 -> 3
       3 -> 6
-      6 -> 1"""
-    rotate_dict = {
-      'cw': {
-        1: 6,
-        6: 3,
-        3: 8,
-        8: 1
-      },
-      'ccw': {
-        1: 8,
-        8: 3,
-        3: 6,
-        6: 1
-      }
-    }
+      6 -> 1
+    Files are grouped by their new orientation and each group (in batches of at most batch files) is written with a
+    single exiftool command. orientations, if given, is a dict of file name -> current orientation for files we
+    already know about; only the rest are asked for. If block is True, progress(files_done, files_total) is called as
+    each batch finishes. If block is False we return the list of (ExifFuture, files in the batch) without waiting."""
     photo_files = [fi for fi in file_list if fi[1]=='file:photo']
-    meta_data = self.get_metadata_for_files(photo_files)
-    query = ''
-    for fi,md in zip(photo_files, meta_data):
-      query += '{:s}\n-Orientation#={:d}\n'.format(fi[0],rotate_dict[dir][md['Orientation']])
-    self.execute(query, expecting_response=False)
-
-  def get_preview_image(self, file):
-    """Return a binary string corresponding to the preview image."""
-    query = '-PreviewImage\n -b\n'
+    orientations = dict(orientations or {})
+    unknown = [fi for fi in photo_files if fi[0] not in orientations]
+    orientations.update(self.get_orientations(unknown))
+    groups = {}
+    for fi in photo_files:
+      if fi[0] not in orientations:
+        logger.warning('Not rotating {:s}, could not read its orientation'.format(fi[0]))
+        continue
+      new_orn = rotate_dict[dir].get(orientations[fi[0]])
+      if new_orn is None: #Mirrored orientations are left alone
+        logger.warning('Not rotating {:s} with orientation {:d}'.format(fi[0], orientations[fi[0]]))
+        continue
+      groups.setdefault(new_orn, []).append(fi[0])
+    jobs = []
+    for new_orn, files in groups.items():
+      for n in range(0, len(files), batch):
+        query = '-Orientation#={:d}\n'.format(new_orn)
+        query += '\n'.join(files[n:n + batch]) + '\n'
+        jobs.append((self.submit(query, expecting_response=False), files[n:n + batch]))
+    if not block: return jobs
+    done, total = 0, sum(len(j[1]) for j in jobs)
+    for future, files in jobs:
+      future.result()
+      done += len(files)
+      if progress: progress(done, total)
+
+  def get_preview_image(self, file, block=True):
+    """Return a bytearray holding the preview image (or an ExifFuture if block is False). Wrap it in a
+    cStringIO.StringIO to hand it to PIL without copying."""
+    return self.get_embedded_image(file, 'PreviewImage', block)
+
+  def get_embedded_image(self, file, tag, block=True):
+    """Return a bytearray holding the embedded image stored under tag, e.g. PreviewImage or JpgFromRaw. Empty if
+    there is none."""
+    query = '-{:s}\n -b\n'.format(tag)
     query += file + '\n'
-    return self.execute(query, expecting_binary=True)
+    future = self.submit(query, expecting_binary=True)
+    return future.result() if block else future
 
-  def get_thumbnail_image(self, file):
-    """Return a binary string corresponding to the preview image."""
+  def get_thumbnail_image(self, file, block=True):
+    """Return a bytearray holding the thumbnail image (or an ExifFuture if block is False)."""
     query = '-ThumbnailImage\n -b\n'
     query += file + '\n'
-    return self.execute(query, expecting_binary=True)
\ No newline at end of file
+    future = self.submit(query, expecting_binary=True)
+    return future.result() if block else future
+
+class GatheredFuture(object):
+  """Joins the ExifFutures of a query that was split into chunks. result() concatenates the chunk results in the
+  order the chunks were submitted."""
+  def __init__(self, futures, then=None):
+    self.futures = futures
+    self.then = then
+
+  def done(self):
+    return all(f.done() for f in self.futures)
+
+  def result(self, timeout=None):
+    """Like ExifFuture.result, returns None if the answers don't all come back within timeout seconds."""
+    deadline = time.time() + timeout if timeout is not None else None
+    result = []
+    for f in self.futures:
+      part = f.result(max(deadline - time.time(), 0) if deadline is not None else None)
+      if part is None: return None
+      result += part
+    if self.then is not None:
+      result = self.then(result)
+    return result
+
+class ExifToolPool(object):
+  """A pool of PersistentExifTool workers that looks like a single PersistentExifTool. A single exiftool process
+  uses one core, so bulk metadata reads are split into chunks and spread over the workers. Writes always go to the
+  first worker, which keeps them in the order they were issued. Workers other than the first are only started the
+  first time a bulk read needs them.
+  If a cache.MetadataCache is passed in (or set as .cache later), photo metadata is served from it when the file has
+  not changed, and only the misses are sent to exiftool."""
+  def __init__(self, workers=0, min_chunk=64, cache=None):
+    """workers=0 means one worker per core. Lists shorter than min_chunk are not split."""
+    self.n_workers = workers if workers > 0 else multiprocessing.cpu_count()
+    self.min_chunk = min_chunk
+    self.cache = cache
+    self.workers = []
+    self.lock = threading.Lock()
+    self.next_worker = 0
+
+  def worker(self, n):
+    """Return worker n, starting it (and any before it) if needed."""
+    with self.lock:
+      while len(self.workers) <= n:
+        self.workers.append(PersistentExifTool())
+      return self.workers[n]
+
+  def any_worker(self):
+    """Round robin over the running workers, for reads that don't care which process answers them."""
+    with self.lock:
+      self.next_worker = (self.next_worker + 1) % max(len(self.workers), 1)
+      n = self.next_worker
+    return self.worker(n)
+
+  def close(self):
+    with self.lock:
+      workers, self.workers = self.workers, []
+    for w in workers:
+      w.close()
+
+  def submit(self, query, expecting_response=True, expecting_binary=False, then=None):
+    return self.worker(0).submit(query, expecting_response, expecting_binary, then)
+
+  def execute(self, query, expecting_response=True, expecting_binary=False):
+    return self.worker(0).execute(query, expecting_response, expecting_binary)
+
+  def get_metadata_for_files(self, file_list, side_car_ext = '.chhobi_movie_sidecar', block=True):
+    """Same as PersistentExifTool.get_metadata_for_files, but the photos are sharded over the workers. Results
+    come back in the same order as from a single worker (photos in input order, followed by the videos)."""
+    photo_files = [fi for fi in file_list if fi[1]=='file:photo']
+    video_files = [fi for fi in file_list if fi[1]=='file:video']
+    cache = self.cache #Set once the GUI has opened it, so look once
+    cached = cache.get([fi[0] for fi in photo_files]) if cache is not None else {}
+    misses = [fi for fi in photo_files if fi[0] not in cached]
+    n_chunks = max(min(self.n_workers, len(misses) // self.min_chunk), 1)
+    chunk_size = -(-len(misses) // n_chunks) #Ceiling division
+    futures = []
+    for n in range(n_chunks):
+      chunk = misses[n*chunk_size:(n+1)*chunk_size]
+      if len(chunk):
+        futures.append(self.worker(n).get_metadata_for_files(chunk, side_car_ext, block=False))
+    if len(video_files):
+      futures.append(self.worker(0).get_metadata_for_files(video_files, side_car_ext, block=False))
+    #Taken now, before exiftool reads the files. If a file is written while the read is in flight the metadata is
+    #stored under the identity it had before, which no longer matches, rather than under the new one
+    identities = cache.identities([fi[0] for fi in misses]) if cache is not None else {}
+    def _merge(meta_data):
+      fetched = dict(by_source_file([fi[0] for fi in misses], meta_data))
+      if cache is not None and len(fetched):
+        cache.put(fetched.items(), identities)
+      photos = [cached.get(fi[0]) or fetched.get(fi[0]) for fi in photo_files]
+      videos = by_source_file([fi[0] for fi in video_files], meta_data)
+      return [md for md in photos if md is not None] + [md for f, md in videos]
+    future = GatheredFuture(futures, then=_merge)
+    return future.result() if block else future
+
+  def set_metadata_for_files(self, file_list, meta_data, block=True):
+    future = self.worker(0).set_metadata_for_files(file_list, meta_data, block=False)
+    future.add_done_callback(lambda f: self.invalidate(file_list))
+    return future.result() if block else future
+
+  def rotate_images(self, file_list, dir, progress=None, batch=100, block=True):
+    """Orientations are taken from the metadata cache where we can, so only unseen files cost an exiftool read. The
+    orientations are still looked up before this returns, even if block is False, so call it off the Tk thread.
+    Each batch's files are dropped from the cache once exiftool has written them."""
+    photo_files = [fi for fi in file_list if fi[1]=='file:photo']
+    cache = self.cache
+    orientations = {}
+    if cache is not None:
+      cached = cache.get([fi[0] for fi in photo_files])
+      orientations = dict((f, md.get('Orientation', 1)) for f, md in cached.items())
+    jobs = self.worker(0).rotate_images(file_list, dir, orientations, batch=batch, block=False)
+    if cache is not None:
+      for future, files in jobs:
+        future.add_done_callback(lambda f, files=files: cache.invalidate(files))
+    if not block: return jobs
+    done, total = 0, sum(len(j[1]) for j in jobs)
+    for future, files in jobs:
+      future.result()
+      done += len(files)
+      if progress: progress(done, total)
+
+  def invalidate(self, file_list):
+    """Drop cached metadata for files we have written to, once the write is done (so a read that was in flight
+    can't put the old metadata back). The cache would notice the new mtime anyway, but mtimes can be coarse."""
+    if self.cache is not None:
+      self.cache.invalidate([fi[0] for fi in file_list])
+
+  def get_preview_image(self, file, block=True):
+    return self.any_worker().get_preview_image(file, block)
+
+  def get_embedded_image(self, file, tag, block=True):
+    return self.any_worker().get_embedded_image(file, tag, block)
+
+  def get_thumbnail_image(self, file, block=True):
+    return self.any_worker().get_thumbnail_image(file, block)
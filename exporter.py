@@ -0,0 +1,55 @@
+"""Resizing the pile for email and the like. The images are decoded, shrunk and saved on a pool of worker processes so
+we use all the cores, and JPEGs are decoded at reduced scale (PIL's draft mode) when the target is much smaller than
+the original, which skips most of the decoding work.
+"""
+import logging
+logger = logging.getLogger(__name__)
+import multiprocessing
+from os.path import join
+from PIL import Image
+
+def export_image(job):
+  """Runs in a worker process. job is (infile, outfile, (W, H)). Returns (infile, error message or None)."""
+  infile, outfile, size = job
+  try:
+    im = Image.open(infile)
+    if im.format == 'JPEG':
+      im.draft('RGB', size) #Decode at the smallest 1/2, 1/4 or 1/8 scale that is still at least as big as size
+    im.thumbnail(size, Image.ANTIALIAS)
+    im.save(outfile, 'JPEG')
+    return infile, None
+  except Exception as e:
+    return infile, str(e)
+
+class PileExporter(object):
+  """Start exporting files into out_dir as 000000.jpg, 000001.jpg ... (in the order given), each fitting in size.
+  Call poll() from the Tk thread to collect finished files; cancel() stops everything."""
+  def __init__(self, files, out_dir, size, processes=0):
+    self.out_dir = out_dir
+    jobs = [(f, join(out_dir, '{:06d}.jpg'.format(n)), size) for n, f in enumerate(files)]
+    self.total = len(jobs)
+    self.done = 0
+    self.errors = []
+    self.pool = multiprocessing.Pool(processes or None)
+    self.results = self.pool.imap_unordered(export_image, jobs)
+    self.pool.close() #No more jobs, workers exit when they are done
+
+  def finished(self):
+    return self.done == self.total
+
+  def poll(self):
+    """Return the (file, error) pairs that finished since the last call, without blocking."""
+    finished = []
+    while not self.finished():
+      try:
+        finished.append(self.results.next(timeout=0))
+      except multiprocessing.TimeoutError:
+        break
+      self.done += 1
+    self.errors += [f for f in finished if f[1] is not None]
+    if self.finished(): self.pool.join()
+    return finished
+
+  def cancel(self):
+    self.pool.terminate()
+    self.pool.join()
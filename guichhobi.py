@@ -52,9 +52,10 @@ c <text>         - set this text as picture caption.
 k <keyword>      - add this keyword to the current file/selection
 k- <keyword>     - remove this keyword from the current file/selection
 s <query string> - perform this mdfinder query and set the file browser to this virtual listing
+                   Results appear as they are found. Esc stops a search that is still running
 cp               - clear all images from pile
 z WxH            - resize all images in pile to fit within H pixels high and W pixels wide,
-                   put them in a temporary directory and reveal the directory
+                   put them in a temporary directory and reveal the directory. Esc cancels
 u key <string>   - Set the api_key
                    If you change the api_key or api_secret, you need to authorize again
 u secret <string>- Set the api_secret
@@ -66,6 +67,15 @@ u code <code>    - enter the code you get after enabling authorization.
                    This allows Chhobi to get tokens and a secret that will let Chhobi upload photos to your account.
 u                - upload currently selected file(s) in the disk browser window
 u p              - upload all files in the pile
+                   Files that have been uploaded before (same contents) are skipped, and uploads that were
+                   interrupted when Chhobi last quit carry on when it restarts
+w                - warm up: fill the metadata, thumbnail and search caches for everything under the root in
+                   the background, so browsing is fast the first time round. Esc stops it, and running it
+                   again carries on where it stopped. warmup.py does the same from the shell
+t                - show timings (calls and p50/p95/p99 latency) for exiftool, ffmpeg, image resizing, the
+                   file browser and searching, and the cache hit counts. Set 'stats dump' in chhobi2.cfg to a
+                   file name to have these written out as JSON every 'stats dump interval' seconds
+t reset          - clear the timings
 
 Search query syntax:
 Chhobi's search is a very thin layer on top of mdfind. The syntax for mdfind is found at
@@ -86,6 +96,11 @@ Some examples of searches are
 s k='rose'  -> find photos with the keyword rose
 s c='*fireworks*'  -> find photos with fireworks in the caption anywhere
 
+Where there is no Spotlight (or if 'search backend' is set to 'local' in the configuration file) searches are run
+against Chhobi's own index instead. This understands the same shortcuts, comparisons joined by && and || (with
+parentheses) and dates written as $time.iso(2013-06-29). Files get into the index when their captions or keywords
+are edited in Chhobi, and when they are added or changed under the photo root while Chhobi is running.
+
 Authorizing Flickr to give Chhobi write access:
 
 1. First you need to set the api_key and api_secret for the application. I do have this combination registered for Chhobi
@@ -109,21 +124,69 @@ Now the credentials for Chhobi writing to you account are set. These credentials
 chhobi configuration file in your home directory.
 
 """
+import time
+started = time.time() #For timing start up
 import logging
 logger = logging.getLogger(__name__)
-import Tkinter as tki, tempfile, argparse, ConfigParser
-from PIL import Image, ImageTk
-import libchhobi as lch, dirbrowser as dirb, libflickr, exiftool
+import Tkinter as tki, tempfile, argparse, ConfigParser, Queue, threading, json, collections
+from PIL import Image
+import libchhobi as lch, dirbrowser as dirb, exiftool, cache, prefetch, searchindex
+import stats, os, sys
 from cStringIO import StringIO
 from os.path import join, expanduser
-
-def resize_image(img, size, orientation):
-  """The transpose is a fairly cheap operation, so we don't bother to resize before we transpose."""
-  if orientation == 3: img = img.transpose(Image.ROTATE_180)
-  elif orientation == 6: img = img.transpose(Image.ROTATE_270)
-  elif orientation == 8: img = img.transpose(Image.ROTATE_90)
-  img.thumbnail(size, Image.ANTIALIAS)
-  return img
+from thumbnails import resize_image, make_thumbnail
+#libflickr (oauth2, httplib2, lxml ...) and PIL.ImageTk are imported when first needed, to keep start up quick
+
+def photo_image(img):
+  from PIL import ImageTk
+  return ImageTk.PhotoImage(img)
+
+class MetadataSummary(object):
+  """What the info pane shows for a selection, built up a chunk of metadata at a time: the caption and keywords
+  common to all the files seen so far and, for more than one file, the range of dates and the cameras used."""
+  detail_keys = ['CreateDate', 'FNumber', 'ShutterSpeed', 'ISO', 'FocalLength', 'DOF','LensID','Model']
+
+  def __init__(self, total):
+    self.total = total
+    self.n = 0
+    self.first = None #Metadata of the first file, for the details of a single file
+    self.captions = None
+    self.keywords = None
+    self.dates = []
+    self.models = collections.Counter()
+
+  def add(self, exiv_data):
+    for md in exiv_data:
+      if self.first is None: self.first = md
+      cap_set = set([md.get('Caption-Abstract', '')])
+      key_set = set([ky for ky in md.get('Keywords', [])])
+      self.captions = cap_set if self.captions is None else self.captions & cap_set
+      self.keywords = key_set if self.keywords is None else self.keywords & key_set
+      if md.get('CreateDate'):
+        self.dates = [min(self.dates + [md['CreateDate']]), max(self.dates + [md['CreateDate']])]
+      if md.get('Model'): self.models[md['Model']] += 1
+    self.n += len(exiv_data)
+
+  def render(self):
+    """Returns the caption, keywords and details text. Plain strings, so they can be handed between threads."""
+    caption = iter(self.captions).next() if self.captions else ''
+    keywords = ', '.join(self.keywords) if self.keywords else ''
+    info_text = '\n'
+    if self.total == 1:
+      for k in self.detail_keys:
+        if self.first.has_key(k):
+          info_text += k.ljust(14) + ': ' + str(self.first[k]) + '\n'
+    else:
+      if self.n < self.total:
+        info_text += '(Showing common info for {:d} of {:d} files ...)\n'.format(self.n, self.total)
+      else:
+        info_text += '(Showing common info for {:d} files)\n'.format(self.total)
+      if len(self.dates):
+        info_text += 'Dates'.ljust(14) + ': ' + self.dates[0] + ' to ' + self.dates[1] + '\n'
+      if len(self.models):
+        info_text += 'Models'.ljust(14) + ': ' + ', '.join(
+          '{:s} ({:d})'.format(m, c) for m, c in self.models.most_common()) + '\n'
+    return caption, keywords, info_text
 
 class MultiPanel():
   """We want to setup a pseudo tabbed widget with three treeviews. One showing the disk, one the pile and
@@ -160,19 +223,62 @@ class MultiPanel():
 
 class App(object):
 
-  def __init__(self):
+  def __init__(self, time_startup=False):
     self.root = tki.Tk()
     self.root.wm_title('Chhobi2')
     self.load_prefs()
     self.init_vars()
     self.setup_window()
-    self.etool = exiftool.PersistentExifTool()
+    self.etool = exiftool.ExifToolPool(workers=self.config.getint('DEFAULT', 'exiftool workers'))
+    self.setup_caches()
+    self.video_thumbnailer = lch.VideoThumbnailer(workers=self.config.getint('DEFAULT', 'video thumbnail workers'))
+    self.prefetcher = prefetch.Prefetcher(self.prefetch_file)
+    self.selection_worker = prefetch.LatestWorker(self.load_selection, name='selection')
+    self.selection_poll_id = None
+    self.watcher = None
     self.setup_uploader()
     self.tab.widget_list[0].set_dir_root(self.config.get('DEFAULT','root'))
+    self.poll_background_messages()
+    self.time_startup = time_startup
+    self.first_paint_id = self.root.bind('<Expose>', self.first_paint, add='+')
+
+  def first_paint(self, event):
+    """Things that can wait until the window is up: opening the on-disk caches, the file watcher, starting exiftool
+    and picking up unfinished uploads (which needs the Flickr code)."""
+    self.root.unbind('<Expose>', self.first_paint_id)
+    stats.record('start up', time.time() - started)
+    if self.time_startup:
+      print json.dumps({'first_paint_s': time.time() - started})
+      self.root.after_idle(self.root.quit)
+      return
+    t = threading.Thread(target=self.background_startup, name='start up')
+    t.daemon = True
+    t.start()
+
+  def background_startup(self):
+    self.open_caches()
+    self.start_watcher()
+    self.etool.worker(0) #Start exiftool so the first selection doesn't wait for it
+    self.resume_uploads()
 
   def cleanup_on_exit(self):
     """Needed to shutdown the exiftool and save configuration."""
+    self.stop_watcher()
+    self.warm_up_cancel()
+    if self.warm_up_thread is not None:
+      self.warm_up_thread.join(10) #It stops after the batch in hand, which needs exiftool and the caches
+      if self.warm_up_thread.is_alive(): logger.warning('Warm up still running, closing the caches under it')
+    self.selection_worker.close()
+    self.prefetcher.close()
+    self.video_thumbnailer.close()
     self.etool.close()
+    with self.caches_lock:
+      if self._metadata_cache is not None:
+        self._metadata_cache.close()
+        self._thumbnail_cache.close()
+        self._search_index.close()
+    if self._upload_journal is not None: self._upload_journal.close()
+    if self.stats_dumper is not None: self.stats_dumper.close()
     if self.showing_preview: self.hide_photo_preview_pane() #This will close the preview pane cleanly (saving geom etc.)
     self.config.set('DEFAULT', 'geometry', self.root.geometry())
     with open(self.config_fname, 'wb') as configfile:
@@ -186,6 +292,19 @@ class App(object):
         'geometry': 'none',
         'preview geometry': 'none',
         'preview delay': '250',
+        'exiftool workers': '0', #0 means one per core
+        'cache dir': '~/.chhobi2',
+        'thumbnail cache MB': '64',
+        'preview cache MB': '128',
+        'prefetch rows': '10',
+        'search backend': 'auto', #mdfind, local or auto (mdfind on Mac OS X, local elsewhere)
+        'watch': 'auto', #Keep the search index up to date by watching root: inotify, poll, auto or off
+        'watch poll interval': '300',
+        'export processes': '0', #0 means one per core
+        'upload workers': '4',
+        'video thumbnail workers': '2', #ffmpeg processes making video thumbnails at once
+        'stats dump': 'none', #File to write the timing stats to as JSON, every 'stats dump interval' seconds
+        'stats dump interval': '60',
         'apikey': 'none',
         'apisecret': 'none',
         'oauthtoken': 'none',
@@ -197,22 +316,130 @@ class App(object):
   def init_vars(self):
     self.cmd_state = 'Idle'
     self.one_key_cmds = ['1', '2', '3', 'r', 'a', 'x', 'h', 'p', '[', ']']
-    self.command_prefix = ['d', 'c', 'k', 's', 'z', 'u']
+    self.command_prefix = ['d', 'c', 'k', 's', 'z', 'u', 'w', 't']
     #If we are in Idle mode and hit any of these keys we move into a command mode and no longer propagate keystrokes to the browser window
     self.pile = set([]) #We temporarily 'hold' files here
     self.cmd_history = lch.CmdHist(memory=20)
     self.showing_preview = False #If true, will update the preview image periodically
     self.preview_delay = self.config.getint('DEFAULT', 'preview delay')
+    self.search_stream = None #The search that is currently filling the search pane
+    self.exporter = None #The pile export that is running
+    self.background_messages = Queue.Queue() #Upload and warm-up threads leave their messages here for the Tk thread
+    self.warm_up = None #The cache warm-up that is running
+    self.warm_up_thread = None
+
+  def setup_caches(self):
+    """The on-disk caches (metadata, search index and thumbnails) are opened by open_caches, off the Tk thread."""
+    self.caches_lock = threading.Lock()
+    self._metadata_cache = None
+    self._search_index = None
+    self._thumbnail_cache = None
+    self.preview_cache = cache.LRUCache(self.config.getint('DEFAULT', 'preview cache MB') * 1024 * 1024)
+    self.setup_stats()
+
+  def open_caches(self):
+    """Runs on the start up thread, or on whichever thread first needs a cache if that comes sooner."""
+    with self.caches_lock:
+      if self._metadata_cache is not None: return
+      cache_dir = expanduser(self.config.get('DEFAULT', 'cache dir'))
+      if not os.path.exists(cache_dir): os.makedirs(cache_dir)
+      self._search_index = searchindex.SearchIndex(join(cache_dir, 'search.sqlite'))
+      self._thumbnail_cache = cache.ThumbnailCache(join(cache_dir, 'thumbnails.pack'),
+                                                   max_bytes=self.config.getint('DEFAULT', 'thumbnail cache MB') * 1024 * 1024)
+      self._metadata_cache = cache.MetadataCache(join(cache_dir, 'metadata.sqlite')) #Last, it marks them all open
+      self.etool.cache = self._metadata_cache
+      for name, c in [('metadata cache', self._metadata_cache), ('thumbnail cache', self._thumbnail_cache.memory)]:
+        stats.gauge(name + ' hits', lambda c=c: c.hits)
+        stats.gauge(name + ' misses', lambda c=c: c.misses)
+
+  @property
+  def metadata_cache(self):
+    self.open_caches()
+    return self._metadata_cache
+
+  @property
+  def search_index(self):
+    self.open_caches()
+    return self._search_index
+
+  @property
+  def thumbnail_cache(self):
+    self.open_caches()
+    return self._thumbnail_cache
+
+  def setup_stats(self):
+    """The caches keep their own hit counts. We just report them along with the timings (the on-disk caches'
+    are added by open_caches)."""
+    stats.gauge('preview cache hits', lambda: self.preview_cache.hits)
+    stats.gauge('preview cache misses', lambda: self.preview_cache.misses)
+    dump = self.config.get('DEFAULT', 'stats dump')
+    self.stats_dumper = None
+    if dump != 'none':
+      self.stats_dumper = stats.JsonDumper(expanduser(dump), self.config.getint('DEFAULT', 'stats dump interval'))
+
+  def start_watcher(self):
+    """Follow changes under root and re-index just the files that changed."""
+    method = self.config.get('DEFAULT', 'watch')
+    if method == 'off': return
+    import watcher
+    self.watcher = watcher.Watcher(self.config.get('DEFAULT', 'root'),
+                                   watcher.IndexUpdater(self.etool, self.search_index, self.metadata_cache),
+                                   method=method, poll_interval=self.config.getint('DEFAULT', 'watch poll interval'))
+
+  def stop_watcher(self):
+    if self.watcher is not None:
+      self.watcher.close()
+      self.watcher = None
 
   def setup_uploader(self):
-    nf = lambda str: str if str != 'none' else None
-    api_key = nf(self.config.get('DEFAULT', 'apikey'))
-    api_secret = nf(self.config.get('DEFAULT', 'apisecret'))
-    oauth_token = nf(self.config.get('DEFAULT', 'oauthtoken'))
-    oauth_token_secret = nf(self.config.get('DEFAULT', 'oauthtokensecret'))
-    self.fup = libflickr.Fup(api_key=api_key, api_secret=api_secret,
-                             oauth_token=oauth_token, oauth_token_secret=oauth_token_secret,
-                             headers={'User-agent': 'Chhobi'})
+    """The Flickr client and the upload journal are made the first time they are used."""
+    self.uploader_lock = threading.Lock()
+    self._fup = None
+    self._upload_journal = None
+
+  @property
+  def fup(self):
+    with self.uploader_lock:
+      if self._fup is None:
+        import libflickr
+        nf = lambda str: str if str != 'none' else None
+        self._fup = libflickr.Fup(api_key=nf(self.config.get('DEFAULT', 'apikey')),
+                                  api_secret=nf(self.config.get('DEFAULT', 'apisecret')),
+                                  oauth_token=nf(self.config.get('DEFAULT', 'oauthtoken')),
+                                  oauth_token_secret=nf(self.config.get('DEFAULT', 'oauthtokensecret')),
+                                  headers={'User-agent': 'Chhobi'})
+      return self._fup
+
+  @property
+  def upload_journal(self):
+    with self.uploader_lock:
+      if self._upload_journal is None:
+        import libflickr
+        cache_dir = expanduser(self.config.get('DEFAULT', 'cache dir'))
+        self._upload_journal = libflickr.UploadJournal(join(cache_dir, 'uploads.sqlite'))
+      return self._upload_journal
+
+  def resume_uploads(self):
+    """Runs on a background thread at start up."""
+    if self.config.get('DEFAULT', 'oauthtoken') == 'none': return
+    unfinished = self.upload_journal.unfinished()
+    if len(unfinished):
+      self.background_messages.put('Resuming {:d} uploads that did not finish last time'.format(len(unfinished)))
+      self.upload_files(unfinished)
+
+  def upload_files(self, fnames):
+    self.fup.upload_files(fnames, self.background_messages.put, workers=self.config.getint('DEFAULT', 'upload workers'),
+                          journal=self.upload_journal)
+
+  def poll_background_messages(self):
+    """The uploader and the warm-up run on their own threads, so their progress messages come to the Tk thread
+    through a queue."""
+    while True:
+      try:
+        self.log_command(self.background_messages.get_nowait())
+      except Queue.Empty:
+        break
+    self.root.after(200, self.poll_background_messages)
 
   def setup_window(self):
     def add_dir_browse(parent):
@@ -271,6 +498,12 @@ class App(object):
         return 'break'
       elif chr in self.command_prefix:
         self.cmd_state = 'Command'
+      elif event.keysym == 'Escape' and (self.search_stream is not None or self.exporter is not None or
+                                         self.warm_up is not None):
+        self.search_cancel()
+        self.export_cancel()
+        self.warm_up_cancel()
+        return 'break'
       else:
         self.propagate_key_to_browser(event)
         return 'break'
@@ -290,67 +523,96 @@ class App(object):
     dir_win.treeview.event_generate('<Key>', keycode=event.keycode)
     self.cmd_win.focus_set()
 
-  def get_thumbnail(self, finfo, orientation):
-    if finfo[1]=='file:photo':
-      im_data = self.etool.get_thumbnail_image(finfo[0])
-      if len(im_data):
-        thumbnail = Image.open(StringIO(im_data))
-      else:
-        logger.debug('No embedded thumnail for {:s}. Generating on the fly.'.format(finfo[0]))
-        #Slow process of generating thumbnail on the fly
-        if finfo[1]=='file:video': return self.chhobi_icon
-        thumbnail = Image.open(finfo[0])
-      thumbnail = resize_image(thumbnail, (150, 150), orientation)
-      #thumbnail.thumbnail((150,150), Image.ANTIALIAS) #Probably slows us down?
-      #thumbnail = orient_image(thumbnail, orientation)
-    else:
-      thumbnail = Image.open(StringIO(lch.get_thumbnail_from_xattr(finfo[0])))
-    return ImageTk.PhotoImage(thumbnail)
+  def load_thumbnail(self, finfo, orientation):
+    """Return the 150x150 thumbnail as a PIL image. Thumbnails we have made before come out of the thumbnail cache
+    without touching exiftool or decoding anything twice."""
+    thumbnail = self.thumbnail_cache.get(finfo[0])
+    if thumbnail is not None: return thumbnail
+    thumbnail = make_thumbnail(self.etool, self.video_thumbnailer, finfo, orientation)
+    if thumbnail is None: return Image.open('icon_sm.pgm') #ffmpeg couldn't manage. Don't cache this
+    self.thumbnail_cache.put(finfo[0], thumbnail)
+    return thumbnail
+
+  def prefetch_file(self, finfo):
+    """Runs on a prefetch thread. Pulls the file's metadata and thumbnail into the caches."""
+    if finfo[1] == 'file:video':
+      self.load_thumbnail(finfo, None) #Video thumbnails are not rotated
+      return
+    exiv_data = self.etool.get_metadata_for_files([finfo])
+    if len(exiv_data):
+      self.load_thumbnail(finfo, exiv_data[0].get('Orientation', None))
 
   def selection_changed(self, event=None):
+    """The metadata and thumbnail are fetched on the selection worker, so the event handler returns at once. If the
+    selection moves on before the worker gets to it (arrow key held down) the old selection is skipped and only the
+    row the cursor comes to rest on is loaded and shown."""
     files = self.tab.active_widget.file_selection()
     logger.debug(files)
     if len(files):
-      exiv_data = self.etool.get_metadata_for_files(files)
-      self.display_exiv_info(exiv_data)
-      orn = exiv_data[0].get('Orientation',None)
-      photo = self.get_thumbnail(files[0], orn)
-      self.thumbnail_label.config(image=photo)
-      self.thumbnail_label.image = photo #Keep a reference
-      if self.showing_preview:
-        if hasattr(self,'showing_after_id'):
-          self.root.after_cancel(self.showing_after_id)
-        self.showing_after_id = self.root.after(self.preview_delay, self.update_photo_preview, files[0], orn)
+      self.selection_worker.submit(files)
+      if self.selection_poll_id is None:
+        self.selection_poll_id = self.root.after(10, self.poll_selection)
     else:
+      self.selection_worker.cancel()
       self.info_text.delete(1.0, tki.END)
       self.thumbnail_label.config(image=self.chhobi_icon)
 
-  def display_exiv_info(self, exiv_data):
-    cap_set = set([exiv_data[0].get('Caption-Abstract', '')])
-    key_set = set([ky for ky in exiv_data[0].get('Keywords', [])])
-    for n in range(1,len(exiv_data)):
-      cap_set &= set([exiv_data[n].get('Caption-Abstract', '')])
-      key_set &= set([ky for ky in exiv_data[n].get('Keywords', [])])
-
-    self.info_text.delete(1.0, tki.END)
-    if len(cap_set):
-      self.info_text.insert(tki.END, cap_set.pop(), ('caption',))
-    info_text = '\n'
-    if len(key_set):
-      info_text += key_set.pop()
-      for key in key_set:
-        info_text += ', ' + key
-      info_text += '\n'
-    self.info_text.insert(tki.END, info_text, ('keywords',))
+  def load_selection(self, files, first_chunk=50, chunk=500):
+    """Runs on the selection worker and posts ('info', caption, keywords, details) and ('thumbnail', files,
+    orientation, image) messages for show_selection. Big selections are read a chunk at a time (with the next
+    chunk already queued on exiftool) and the info is posted after every chunk, so it shows up straight away and
+    fills in as we go. We stop as soon as the selection changes."""
+    chunks = [files[:first_chunk]] + [files[n:n + chunk] for n in range(first_chunk, len(files), chunk)]
+    summary = MetadataSummary(len(files))
+    future = self.etool.get_metadata_for_files(chunks[0], block=False)
+    for k in range(len(chunks)):
+      exiv_data = future.result()
+      if self.selection_worker.superseded(): return None
+      if k + 1 < len(chunks):
+        future = self.etool.get_metadata_for_files(chunks[k + 1], block=False)
+      summary.add(exiv_data)
+      if summary.n: self.selection_worker.post(('info',) + summary.render())
+      if k == 0:
+        orn = exiv_data[0].get('Orientation',None) if len(exiv_data) else None
+        self.selection_worker.post(('thumbnail', files, orn, self.load_thumbnail(files[0], orn)))
+    return None
+
+  def poll_selection(self):
+    busy = self.selection_worker.pending() #Checked first, so nothing posted before the worker finished is missed
+    while True:
+      try:
+        generation, message = self.selection_worker.results.get_nowait()
+      except Queue.Empty:
+        break
+      if generation == self.selection_worker.generation: #Anything older is out of date
+        self.show_selection(message)
+    if busy:
+      self.selection_poll_id = self.root.after(10, self.poll_selection)
+    else:
+      self.selection_poll_id = None
 
-    info_text = '\n'
-    if len(exiv_data) == 1:
-      for k in ['CreateDate', 'FNumber', 'ShutterSpeed', 'ISO', 'FocalLength', 'DOF','LensID','Model']:
-        if exiv_data[0].has_key(k):
-          info_text += k.ljust(14) + ': ' + str(exiv_data[0][k]) + '\n'
+  def show_selection(self, message):
+    if message[0] == 'info':
+      self.display_exiv_info(*message[1:])
     else:
-      info_text += '(Showing common info)'
-    self.info_text.insert(tki.END, info_text)
+      self.show_thumbnail(*message[1:])
+
+  def show_thumbnail(self, files, orn, thumbnail):
+    photo = photo_image(thumbnail)
+    self.thumbnail_label.config(image=photo)
+    self.thumbnail_label.image = photo #Keep a reference
+    if self.showing_preview:
+      if hasattr(self,'showing_after_id'):
+        self.root.after_cancel(self.showing_after_id)
+      self.showing_after_id = self.root.after(self.preview_delay, self.update_photo_preview, files[0], orn)
+    self.prefetcher.prefetch(self.tab.active_widget.neighbours(self.config.getint('DEFAULT', 'prefetch rows')))
+
+  def display_exiv_info(self, caption, keywords, details):
+    """Takes the texts from MetadataSummary.render"""
+    self.info_text.delete(1.0, tki.END)
+    self.info_text.insert(tki.END, caption, ('caption',))
+    self.info_text.insert(tki.END, '\n' + (keywords + '\n' if len(keywords) else ''), ('keywords',))
+    self.info_text.insert(tki.END, details)
 
   def single_key_command_execute(self, chr):
     if chr == '1':
@@ -383,14 +645,17 @@ class App(object):
     elif command[:2] == 'c ':
       caption = command[2:].strip()
       self.etool.set_metadata_for_files(files, {'caption': caption})
+      self.search_index.index_files(self.etool, files)
       self.selection_changed(None) #Need to refresh stuff
     elif command[:2] == 'k ':
       keyword = command[2:].strip()
       self.etool.set_metadata_for_files(files, {'keywords': [('+',keyword)]})
+      self.search_index.index_files(self.etool, files)
       self.selection_changed(None) #Need to refresh stuff
     elif command[:2] == 'k-':
       keyword = command[3:].strip()
       self.etool.set_metadata_for_files(files, {'keywords': [('-',keyword)]})
+      self.search_index.index_files(self.etool, files)
       self.selection_changed(None) #Need to refresh stuff
     elif command[0] == 's':
       self.search_execute(command[2:].strip())
@@ -400,6 +665,13 @@ class App(object):
       self.resize_and_show(command[2:].strip().lower().split('x'))
     elif command[:1] == 'u':
       self.uploader(command[1:].strip())
+    elif command.strip() == 'w':
+      self.warm_up_caches()
+    elif command.strip() == 't':
+      self.show_stats()
+    elif command.strip() == 't reset':
+      stats.registry.reset()
+      self.log_command('Cleared timing stats')
 
     self.cmd_win.delete(1.0, tki.END)
     self.cmd_state = 'Idle'
@@ -410,9 +682,20 @@ class App(object):
       self.log_win.after_cancel(self.log_win_after_id)
     self.log_win.insert(tki.END, '|' + cmd)
     self.log_win_after_id = self.log_win.after(2000, self.clear_log_command)
+    self.log_status_index = None
+
+  def log_status(self, msg):
+    """Like log_command, but a message from log_status replaces the one before it, so progress reports don't pile
+    up in the log window."""
+    if getattr(self, 'log_status_index', None) is not None:
+      self.log_win.delete(self.log_status_index, tki.END)
+    index = self.log_win.index('end-1c')
+    self.log_command(msg)
+    self.log_status_index = index
 
   def clear_log_command(self):
     self.log_win.delete(1.0, tki.END)
+    self.log_status_index = None
 
   def command_cancel(self):
     self.cmd_win.delete(1.0, tki.END)
@@ -435,13 +718,68 @@ class App(object):
   def set_new_photo_root(self, new_root):
     self.config.set('DEFAULT', 'root', new_root)
     self.tab.widget_list[0].set_dir_root(new_root) #0 is the disk browser
+    self.stop_watcher()
+    self.start_watcher()
+
+  def search_index_backend(self):
+    """Return the local search index if we are meant to use it instead of mdfind, otherwise None."""
+    backend = self.config.get('DEFAULT', 'search backend')
+    if backend == 'local' or (backend == 'auto' and sys.platform != 'darwin'):
+      return self.search_index
+    return None
 
   def search_execute(self, query_str):
+    """The search runs on a background thread and its results are fed into the search pane as they arrive. A new
+    search (or Esc) cancels the one in progress."""
+    self.search_cancel()
     self.log_command('Searching for {:s}'.format(lch.query_to_rawquery(query_str)))
-    files = lch.execute_query(query_str, root = self.config.get('DEFAULT', 'root'))
-    self.tab.widget_list[1].virtual_flat(files, title='Search result') #1 is the search window
+    stream = lch.QueryStream(query_str, root = self.config.get('DEFAULT', 'root'), index=self.search_index_backend())
+    results = Queue.Queue()
+    def _run():
+      try:
+        for path in stream:
+          results.put(path)
+        results.put(None)
+      except Exception as e:
+        results.put(e)
+    self.search_stream = stream
+    search_thread = threading.Thread(target=_run, name='search')
+    search_thread.daemon = True
+    search_thread.start()
+    self.tab.widget_list[1].virtual_flat([], title='Search result') #1 is the search window
     self.show_search()
-    self.log_command('Found {:d} files.'.format(len(files)))
+    self.poll_search(stream, results, 0)
+
+  def poll_search(self, stream, results, count, batch=500):
+    if stream is not self.search_stream: return #Superseded or canceled
+    paths, finished = [], False
+    while len(paths) < batch:
+      try:
+        item = results.get_nowait()
+      except Queue.Empty:
+        break
+      if item is None or isinstance(item, Exception):
+        finished = True
+        if isinstance(item, Exception):
+          logger.error(item)
+          self.log_command(str(item))
+        break
+      paths.append(item)
+    if len(paths):
+      self.tab.widget_list[1].virtual_append(paths)
+      count += len(paths)
+    if finished:
+      self.search_stream = None
+      self.log_command('Found {:d} files.'.format(count))
+    else:
+      if len(paths): self.log_command('Found {:d} files so far...'.format(count))
+      self.root.after(50, self.poll_search, stream, results, count)
+
+  def search_cancel(self):
+    if self.search_stream is not None:
+      self.search_stream.cancel()
+      self.search_stream = None
+      self.log_command('Search canceled.')
 
   def open_external(self, event):
     files = self.tab.active_widget.file_selection()#Only returns files
@@ -488,14 +826,34 @@ class App(object):
     self.log_command('Search results')
 
   def resize_and_show(self, size):
+    """The resizing runs on a pool of processes (see exporter.py). We poll it for progress and reveal the directory
+    once everything is done. Esc cancels."""
     size = (int(size[0]), int(size[1]))
     out_dir = tempfile.mkdtemp()
-    for n,file in enumerate(self.pile):
-      outfile = join(out_dir, '{:06d}.jpg'.format(n))
-      im = Image.open(file)
-      im.thumbnail(size, Image.ANTIALIAS)
-      im.save(outfile, 'JPEG')
-    lch.reveal_file_in_finder([out_dir])
+    self.export_cancel()
+    import exporter
+    self.exporter = exporter.PileExporter(list(self.pile), out_dir, size,
+                                          processes=self.config.getint('DEFAULT', 'export processes'))
+    self.poll_export(self.exporter)
+
+  def poll_export(self, exp):
+    if exp is not self.exporter: return #Canceled
+    finished = exp.poll()
+    for file, error in finished:
+      if error is not None: logger.error('Could not export {:s}: {:s}'.format(file, error))
+    if exp.finished():
+      self.exporter = None
+      self.log_status('Exported {:d} files ({:d} failed)'.format(exp.total, len(exp.errors)))
+      lch.reveal_file_in_finder([exp.out_dir])
+    else:
+      if len(finished): self.log_status('Exported {:d} of {:d}'.format(exp.done, exp.total))
+      self.root.after(100, self.poll_export, exp)
+
+  def export_cancel(self):
+    if self.exporter is not None:
+      self.exporter.cancel()
+      self.exporter = None
+      self.log_command('Export canceled.')
 
   def show_photo_preview_pane(self):
     if self.showing_preview: return
@@ -516,8 +874,8 @@ class App(object):
     files = self.tab.active_widget.file_selection()
     if len(files) > 0:
       exiv_data = self.etool.get_metadata_for_files([files[0]])
-      orn = exiv_data[0].get('Orientation',None)
-      self.update_photo_preview(files[0], orn)
+      if len(exiv_data): #exiftool couldn't read it, leave the pane empty
+        self.update_photo_preview(files[0], exiv_data[0].get('Orientation',None))
 
     self.cmd_win.focus_force() #Want to keep focus in command window
 
@@ -528,17 +886,124 @@ class App(object):
     self.config.set('DEFAULT', 'preview geometry', self.preview_pane.geometry())
     self.preview_pane.destroy()
 
+  def load_preview(self, finfo, size, orientation):
+    """Return the preview as a PIL image fitting in size. We use the embedded preview (or, for raw files, the
+    embedded full size JPEG) when it is big enough for the pane, and only decode the original when it isn't.
+    Decoded previews are cached per file and pane size."""
+    key = (finfo[0], cache.file_identity(finfo[0]), tuple(size))
+    img = self.preview_cache.get(key)
+    if img is not None: return img
+    swap = orientation in [6, 8] #The image is on its side
+    best = None #The biggest embedded image, in case PIL can't read the original (e.g. NEF)
+    for tag in ['PreviewImage', 'JpgFromRaw']: #JpgFromRaw is several MB, so only asked for if we need it
+      data = self.etool.get_embedded_image(finfo[0], tag)
+      if not len(data): continue
+      try:
+        candidate = Image.open(StringIO(data))
+      except IOError:
+        logger.warning('Could not decode the {:s} of {:s}'.format(tag, finfo[0]))
+        continue
+      w, h = candidate.size[::-1] if swap else candidate.size
+      if w >= size[0] or h >= size[1]: #Scaling down (or exactly fits) - good enough
+        img = candidate
+        break
+      if best is None or w * h > best.size[0] * best.size[1]: best = candidate
+    if img is None:
+      try:
+        img = Image.open(finfo[0])
+      except IOError:
+        if best is None: raise
+        img = best
+      #PIL opens a NEF as a TIFF and gives us the tiny thumbnail in IFD0, so go by size rather than errors
+      if best is not None and img.size[0] * img.size[1] < best.size[0] * best.size[1]: img = best
+    if img.format == 'JPEG':
+      img.draft('RGB', (size[1], size[0]) if swap else tuple(size))
+    img = resize_image(img, size, orientation)
+    self.preview_cache.put(key, img, img.size[0] * img.size[1] * len(img.getbands()))
+    return img
+
   def update_photo_preview(self, finfo, orientation):
     if finfo[1]=='file:video': return
     size = [int(x) for x in self.preview_pane.geometry().split('+')[0].split('x')]
-    photo_preview = ImageTk.PhotoImage(resize_image(Image.open(finfo[0]), size, orientation))
+    try:
+      photo_preview = photo_image(self.load_preview(finfo, size, orientation))
+    except IOError as e: #Neither the embedded images nor the original would decode
+      logger.error('No preview for {:s}: {:s}'.format(finfo[0], str(e)))
+      self.preview_label.config(image='')
+      self.preview_label.image = None
+      return
     self.preview_label.config(image=photo_preview)
     self.preview_label.image = photo_preview #Keep a reference
 
+  def warm_up_caches(self):
+    """Fill the caches for everything under root on a background thread (see warmup.py)."""
+    if self.warm_up is not None:
+      self.log_command('Already warming up')
+      return
+    def _progress(stats):
+      self.background_messages.put('Warm up: {done:d} warmed, {skipped:d} already warm of {total:d} '
+                                   '({files_per_s:.1f} files/s)'.format(**stats))
+    def _run(warm_up, root):
+      try:
+        stats = warm_up.run(root)
+        self.background_messages.put('Warm up {:s}: {:d} files in {:.0f}s ({:.1f} files/s)'.format(
+          'cancelled' if stats['cancelled'] else 'finished', stats['done'], stats['seconds'], stats['files_per_s']))
+      except Exception as e:
+        logger.exception('Warming up')
+        self.background_messages.put('Warm up failed: {:s}'.format(str(e)))
+      self.warm_up = None
+    import warmup
+    self.warm_up = warmup.WarmUp(self.etool, self.metadata_cache, self.thumbnail_cache, self.search_index,
+                                 self.video_thumbnailer, progress=_progress)
+    self.warm_up_thread = threading.Thread(target=_run, args=(self.warm_up, self.config.get('DEFAULT', 'root')),
+                                           name='warm up')
+    self.warm_up_thread.daemon = True
+    self.warm_up_thread.start()
+    self.log_command('Warming up the caches')
+
+  def warm_up_cancel(self):
+    if self.warm_up is not None:
+      self.warm_up.cancel()
+      self.log_command('Stopping the warm up after this batch')
+
   def rotate_selection(self, dir):
+    """The orientations are looked up and the writes queued on exiftool from a background thread, and we poll for
+    the writes to finish, so the UI stays live for big selections."""
     files = self.tab.active_widget.file_selection()
-    self.etool.rotate_images(files, dir)
-    self.selection_changed()
+    queued = Queue.Queue()
+    def _run():
+      try:
+        queued.put(self.etool.rotate_images(files, dir, block=False))
+      except Exception as e:
+        queued.put(e)
+    t = threading.Thread(target=_run, name='rotate')
+    t.daemon = True
+    t.start()
+    self.poll_rotation_queued(queued)
+
+  def poll_rotation_queued(self, queued):
+    try:
+      jobs = queued.get_nowait()
+    except Queue.Empty:
+      self.root.after(50, self.poll_rotation_queued, queued)
+      return
+    if isinstance(jobs, Exception):
+      logger.error(jobs)
+      self.log_status(str(jobs))
+      return
+    self.poll_rotation(jobs, 0, sum(len(j[1]) for j in jobs))
+
+  def poll_rotation(self, jobs, done, total):
+    was_done = done
+    while len(jobs) and jobs[0][0].done():
+      jobs[0][0].result()
+      done += len(jobs.pop(0)[1])
+    if len(jobs):
+      if done != was_done: self.log_status('Rotated {:d} of {:d}'.format(done, total))
+      self.root.after(50, self.poll_rotation, jobs, done, total)
+    else:
+      self.log_status('Rotated {:d} files'.format(total))
+      self.selection_changed()
 
   def uploader(self, command):
     """
@@ -553,11 +1018,12 @@ class App(object):
                        This allows Chhobi to get tokens and a secret that will let Chhobi upload photos to your account.
     u                - upload currently selected file(s) in the disk browser window
     u p              - upload all files in the pile
+                       Files that have been uploaded before (same contents) are skipped
     """
     if command == '':
-      self.fup.upload_files([f[0] for f in self.tab.widget_list[0].file_selection()],self.log_command)#Only returns files
+      self.upload_files([f[0] for f in self.tab.widget_list[0].file_selection()])#Only returns files
     elif command == 'p':
-      self.fup.upload_files(self.pile, self.log_command)
+      self.upload_files(self.pile)
     elif command[:3] == 'key':
       self.fup.set_state(api_key = command[3:].strip())
       self.config.set('DEFAULT','apikey', self.fup.api_key)
@@ -575,6 +1041,14 @@ class App(object):
       self.config.set('DEFAULT','oauthtokensecret', self.fup.oauth_token_secret)
       self.log_command('Authorized')
 
+  def show_stats(self):
+    top = tki.Toplevel()
+    top.title("Timings")
+    msg = tki.Text(top, font=('consolas', 11), wrap=tki.NONE)
+    msg.insert(tki.END, stats.registry.report())
+    msg.pack(expand=True, fill='both')
+    self.log_command('Showing timings')
+
   def show_help(self):
     top = tki.Toplevel()
     top.title("Help")
@@ -586,6 +1060,8 @@ class App(object):
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
   parser.add_argument('-d', default=False, action='store_true', help='Print debugging messages')
+  parser.add_argument('--time-startup', default=False, action='store_true',
+                      help='Print the time to first paint as JSON and quit (used by benchmark.py)')
   args,_ = parser.parse_known_args()
   if args.d:
     level=logging.DEBUG
@@ -593,5 +1069,5 @@ if __name__ == "__main__":
     level=logging.INFO
   logging.basicConfig(level=level)
 
-  app = App()
+  app = App(time_startup=args.time_startup)
   app.root.mainloop()
\ No newline at end of file
@@ -8,7 +8,8 @@ c) Create smartfolders based on search criteria
 import logging
 logger = logging.getLogger(__name__)
 from subprocess import Popen, PIPE, list2cmdline
-import re, collections, xattr, biplist, os
+import re, collections, xattr, biplist, os, threading, time, tempfile, stats
+from multiprocessing.pool import ThreadPool
 
 #The regexp for substituting mdfind syntax into our simplified syntax
 #http://docs.python.org/2/library/re.html
@@ -24,6 +25,28 @@ query_map = {
   'l': 'kMDItemFocalLength'
 }
 
+#File extensions (lower case, without the dot) Chhobi treats as photos and videos
+photo_ext = ['jpg', 'tiff', 'gif', 'png', 'raw', 'nef']
+video_ext = ['avi', 'mov', 'm4v', 'mkv']
+
+def ext_type_map(photo_ext=photo_ext, video_ext=video_ext):
+  """Extension -> 'file:photo' or 'file:video', so classifying a file name is one dict lookup."""
+  ext_map = dict((ext, 'file:photo') for ext in photo_ext)
+  ext_map.update((ext, 'file:video') for ext in video_ext)
+  return ext_map
+
+default_ext_map = ext_type_map()
+
+def media_type(path, ext_map=default_ext_map):
+  """Return 'file:photo', 'file:video' or None going by the file extension alone (no stat)."""
+  return ext_map.get(os.path.splitext(path)[1][1:].lower())
+
+def to_unicode(s):
+  """sqlite (and the search index's regexps) want unicode. Paths and strings from exiftool come in as utf-8."""
+  if isinstance(s, str): return s.decode('utf-8')
+  if isinstance(s, unicode): return s
+  return unicode(s)
+
 def query_to_rawquery(query):
   """Make substitutions to convert a human readable query into a mdfinder readable query."""
   def _match_sub(match):
@@ -32,10 +55,64 @@ def query_to_rawquery(query):
 
   return query_re.sub(_match_sub, query)
 
-def execute_query(query, root = './'):
-  raw_query = query_to_rawquery(query)
-  cmd_args = ['mdfind', '-onlyin', root, raw_query]
-  return execute_long(cmd_args)
+def execute_query(query, root = './', index=None):
+  """Run the query with mdfind, or against index (a searchindex.SearchIndex) if one is given. Blocks until all the
+  results are in."""
+  return list(QueryStream(query, root, index))
+
+class QueryStream(object):
+  """Iterate over this to get search results as they are produced. With mdfind we ask for NUL separated output
+  (-0) and read it straight off the pipe, so there is no temporary file and the first paths arrive long before a
+  broad query finishes. cancel() may be called from another thread and stops the iteration early."""
+  def __init__(self, query, root = './', index=None):
+    self.query = query
+    self.root = root
+    self.index = index
+    self.process = None
+    self.cancelled = False
+
+  def __iter__(self):
+    """Records the time the query took, from start to the last result (or cancel), as 'mdfind' or 'search index'."""
+    t0 = time.time()
+    try:
+      for path in self.paths():
+        yield path
+    finally:
+      stats.record('search index' if self.index is not None else 'mdfind', time.time() - t0)
+
+  def paths(self):
+    if self.index is not None:
+      for path in self.index.search(self.query, self.root):
+        if self.cancelled: return
+        yield path
+      return
+    cmd_args = ['mdfind', '-0', '-onlyin', self.root, query_to_rawquery(self.query)]
+    logger.debug(list2cmdline(cmd_args))
+    errors = tempfile.TemporaryFile() #Not a pipe - nobody reads it until the end, so a pipe could fill up and block
+    self.process = Popen(cmd_args, stdout=PIPE, stderr=errors)
+    fd = self.process.stdout.fileno()
+    partial = b''
+    try:
+      while not self.cancelled:
+        chunk = os.read(fd, 65536)
+        if not chunk: break
+        paths = (partial + chunk).split(b'\0')
+        partial = paths.pop() #Whatever follows the last NUL is incomplete
+        for path in paths:
+          if self.cancelled: return
+          yield path
+    finally:
+      self.cancel()
+      errors.seek(0)
+      message = errors.read().strip()
+      errors.close()
+      if len(message): logger.error(message)
+
+  def cancel(self):
+    self.cancelled = True
+    if self.process is not None and self.process.poll() is None:
+      self.process.terminate()
+      self.process.wait()
 
 def execute(prog_args, blocking=True):
   """If blocking is True, use wait to get result. Otherwise simply return with no error checking etc etc."""
@@ -48,18 +125,6 @@ def execute(prog_args, blocking=True):
   else: #Non-blocking, return immediately
     return []
 
-def execute_long(prog_args):
-  """Don't use PIPE for stdout, use a file. Block
-  Needed for queries because PIPE barfs even for small amounts of data
-  """
-  logger.debug(list2cmdline(prog_args))
-  with open('query.txt','w') as stdout:
-    p = Popen(prog_args, stdin=PIPE, stdout=stdout, stderr=PIPE)
-    if p.wait():
-      logger.error(p.stderr.read())
-  with open('query.txt','r') as stdout:
-    return stdout.read().splitlines()
-
 def quick_look_file(files, mode='-p'):
   #mode can be -t or -p
   Popen(['open'] + files)
@@ -73,7 +138,7 @@ def read_xattr_metadata(file_list):
   """For the given list of files read us the kMDItemDescription and kMDItemKeywords."""
   meta_data = []
   for file in file_list:
-    md = {}
+    md = {'SourceFile': file}
     attrs = xattr.listxattr(file)
     if 'com.apple.metadata:kMDItemDescription' in attrs:
       md['Caption-Abstract'] = biplist.readPlistFromString(xattr.getxattr(file, 'com.apple.metadata:kMDItemDescription'))
@@ -101,20 +166,78 @@ def write_xattr_metadata(file_list, meta_data):
       xattr.setxattr(file, 'com.apple.metadata:kMDItemKeywords', biplist.writePlistToString(list(orig_keywd_list)))
 
 def get_thumbnail_from_xattr(file, tsize=150):
-  """Look for thumbnail in xattr or use ffmpeg to generate one (and store it in xattr).
+  """Look for thumbnail in xattr or use ffmpeg to generate one (and store it in xattr)."""
+  thumb_data = read_thumbnail_xattr(file)
+  if thumb_data is None:
+    thumb_data = make_video_thumbnail(file, tsize)
+    if len(thumb_data): xattr.setxattr(file, 'chhobi2:thumbnail', thumb_data)
+  return thumb_data
+
+def read_thumbnail_xattr(file):
+  if 'chhobi2:thumbnail' in xattr.listxattr(file):
+    return xattr.getxattr(file, 'chhobi2:thumbnail')
+  return None
+
+def make_video_thumbnail(file, tsize=150):
+  """Grab a frame from the video as a JPEG no wider than tsize. ffmpeg writes it to stdout (image2pipe) so there is
+  no temporary file and any number of these can run at once. Returns an empty string if ffmpeg could not do it.
   ffmpeg command from http://stackoverflow.com/questions/14551102/with-ffmpeg-create-thumbnails-proportional-to-the-videos-ratio
-  e.g. ffmpeg -itsoffset -1 -i TestData/2013-06-29/MVI_0843.AVI -vframes 1 -filter:v scale="min(150\, iw):-1"  out.jpg
+  e.g. ffmpeg -itsoffset -1 -i TestData/2013-06-29/MVI_0843.AVI -vframes 1 -filter:v scale="min(150\, iw):-1" -f image2pipe -vcodec mjpeg -
   Note that list form of Popen takes care of the quoting - nothing special needs to be done.
   """
-  if 'chhobi2:thumbnail' in xattr.listxattr(file):
-    return xattr.getxattr(file, 'chhobi2:thumbnail')
-  ftemp = 'chhobi2_thumb_temp.jpg'
-  Popen(['ffmpeg', '-loglevel', 'panic', '-itsoffset', '-1', '-i', file, '-vframes', '1', '-filter:v', 'scale=min({:d}\, iw):-1'.format(tsize), ftemp]).wait() #This takes a finite amount of time
-  thumb_data = open(ftemp, 'rb').read()
-  os.remove(ftemp) #Clean up after ourselves
-  xattr.setxattr(file, 'chhobi2:thumbnail', thumb_data)
+  with open(os.devnull, 'w') as devnull, stats.timed('ffmpeg'):
+    p = Popen(['ffmpeg', '-loglevel', 'panic', '-itsoffset', '-1', '-i', file, '-vframes', '1',
+               '-filter:v', 'scale=min({:d}\, iw):-1'.format(tsize), '-f', 'image2pipe', '-vcodec', 'mjpeg', '-'],
+              stdin=devnull, stdout=PIPE, stderr=devnull)
+    thumb_data, _ = p.communicate()
   return thumb_data
 
+class VideoThumbnailer(object):
+  """Makes video thumbnails, running at most workers ffmpeg processes at a time however many threads ask for them.
+  Results still go into the chhobi2:thumbnail xattr. If a thumbnail is asked for while another thread is already
+  making it the second caller just waits for the first."""
+  def __init__(self, workers=2, tsize=150):
+    self.workers = workers
+    self.tsize = tsize
+    self.slots = threading.Semaphore(workers)
+    self.lock = threading.Lock()
+    self.in_progress = {} #file -> [threading.Event, thumbnail data]
+    self.pool = None
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool = None
+
+  def get(self, file):
+    """The JPEG thumbnail data for the video (empty if ffmpeg could not make one). Blocks till it is ready."""
+    thumb_data = read_thumbnail_xattr(file)
+    if thumb_data is not None: return thumb_data
+    with self.lock:
+      job = self.in_progress.get(file)
+      owner = job is None
+      if owner: job = self.in_progress[file] = [threading.Event(), '']
+    if not owner:
+      job[0].wait()
+      return job[1]
+    try:
+      with self.slots:
+        job[1] = get_thumbnail_from_xattr(file, self.tsize)
+    except (OSError, IOError) as e:
+      logger.warning('Could not make a thumbnail for {:s}: {:s}'.format(file, str(e)))
+    finally:
+      with self.lock:
+        del self.in_progress[file]
+      job[0].set()
+    return job[1]
+
+  def generate(self, file_list):
+    """Make thumbnails for a batch of videos in the background. Returns an iterator over (file, thumbnail data) in
+    the order they finish."""
+    if self.pool is None:
+      self.pool = ThreadPool(self.workers)
+    return self.pool.imap_unordered(lambda f: (f, self.get(f)), file_list)
+
 class CmdHist:
   """A tiny class to implement a crude command history. We keep adding new commands to the deque. Older
    commands are forgotten (the deque has a finite length). When we want to ask for completion we send
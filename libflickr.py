@@ -5,7 +5,7 @@ version 0.3.0
 """
 import logging
 logger = logging.getLogger(__name__)
-import webbrowser, threading
+import webbrowser, threading, time, socket, httplib, Queue, os, sqlite3, hashlib
 
 import urllib, urllib2, mimetypes, mimetools, codecs, httplib2
 from io import BytesIO
@@ -15,6 +15,8 @@ try:
   from urlparse import parse_qsl
 except ImportError:
   from cgi import parse_qsl
+from urlparse import urlparse
+from libchhobi import to_unicode as _u
 
 try:
   import simplejson as json
@@ -65,6 +67,74 @@ def iter_fields(fields):
   return ((k, v) for k, v in fields)
 
 
+class MultipartBody(object):
+  """A multipart/form-data body that is produced as it is sent instead of being built in memory. Fields are as for
+  FlickrAPI.encode_multipart_formdata except that a file field is (filename, open file object) and the file is
+  read in chunk_size pieces as the body goes out. len() gives the exact size up front for Content-Length.
+
+  It has a read() method, so httplib and urllib2 will stream it straight to the socket.
+  """
+  def __init__(self, fields, boundary=None, chunk_size=64 * 1024):
+    self.boundary = boundary or mimetools.choose_boundary()
+    self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+    self.chunk_size = chunk_size
+    self.segments = [] #Strings, or open files
+    self.length = 0
+    for fieldname, value in iter_fields(fields):
+      if isinstance(value, tuple):
+        filename, data = value
+        header = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n\r\n'
+                  % (self.boundary, fieldname, filename, get_content_type(filename)))
+      else:
+        data = value
+        header = ('--%s\r\nContent-Disposition: form-data; name="%s"\r\nContent-Type: text/plain\r\n\r\n'
+                  % (self.boundary, fieldname))
+      self.add(header)
+      if hasattr(data, 'read'):
+        self.segments.append(data)
+        self.length += os.fstat(data.fileno()).st_size - data.tell()
+      else:
+        self.add(str(data) if isinstance(data, int) else data)
+      self.add(b'\r\n')
+    self.add('--%s--\r\n' % (self.boundary))
+    self.chunks = iter(self)
+    self.leftover = b''
+
+  def add(self, s):
+    if isinstance(s, unicode): s = s.encode('utf-8')
+    self.segments.append(s)
+    self.length += len(s)
+
+  def __len__(self):
+    return self.length
+
+  def __iter__(self):
+    for seg in self.segments:
+      if isinstance(seg, str):
+        yield seg
+      else:
+        while True:
+          chunk = seg.read(self.chunk_size)
+          if not chunk: break
+          yield chunk
+
+  def read(self, size=-1):
+    """File-like read, for httplib."""
+    out = [self.leftover]
+    n = len(self.leftover)
+    while size < 0 or n < size:
+      try:
+        chunk = next(self.chunks)
+      except StopIteration:
+        break
+      out.append(chunk)
+      n += len(chunk)
+    data = b''.join(out)
+    if size < 0: size = len(data)
+    self.leftover = data[size:]
+    return data[:size]
+
+
 class FlickrAPIError(Exception):
   """ Generic catch-all error class"""
   def __init__(self, msg, error_code=None):
@@ -212,34 +282,8 @@ class FlickrAPI(object):
     if method == 'POST':
 
       if files is not None:
-        # To upload/replace file, we need to create a fake request
-        # to sign parameters that are not multipart before we add
-        # the multipart file to the parameters...
-        # OAuth is not meant to sign multipart post data
-        http_url = self.replace_api_url if replace else self.upload_api_url
-        faux_req = oauth.Request.from_consumer_and_token(self.consumer,
-                                                         token=self.token,
-                                                         http_method="POST",
-                                                         http_url=http_url,
-                                                         parameters=params)
-
-        faux_req.sign_request(oauth.SignatureMethod_HMAC_SHA1(),
-                              self.consumer,
-                              self.token)
-
-        all_upload_params = dict(parse_qsl(faux_req.to_postdata()))
-
-        # For Tumblr, all media (photos, videos)
-        # are sent with the 'data' parameter
-        all_upload_params['photo'] = (files.name, files.read())
-        body, content_type = self.encode_multipart_formdata(all_upload_params)
-
-        self.headers.update({
-          'Content-Type': content_type,
-          'Content-Length': str(len(body))
-        })
-
-        req = urllib2.Request(http_url, body, self.headers)
+        http_url, body, headers = self.prepare_upload(files, params, replace)
+        req = urllib2.Request(http_url, body, headers)
         try:
           req = urllib2.urlopen(req)
         except urllib2.HTTPError, e:
@@ -248,46 +292,10 @@ class FlickrAPI(object):
           resp = {'status': e.code}
           content = e.read()
 
-        # After requests is finished, delete Content Length & Type so
-        # requests after don't use same Length and take (i.e 20 sec)
-        del self.headers['Content-Type']
-        del self.headers['Content-Length']
-
         # If no error, assume response was 200
         resp = {'status': 200}
 
-        content = req.read()
-        content = etree.XML(content)
-
-        stat = content.get('stat') or 'ok'
-
-        if stat == 'fail':
-          if content.find('.//err') is not None:
-            code = content.findall('.//err[@code]')
-            msg = content.findall('.//err[@msg]')
-
-            if len(code) > 0:
-              if len(msg) == 0:
-                msg = 'An error occurred making your Flickr API request.'
-              else:
-                msg = msg[0].get('msg')
-
-              code = int(code[0].get('code'))
-
-              content = {
-                'stat': 'fail',
-                'code': code,
-                'message': msg
-              }
-        else:
-          photoid = content.find('.//photoid')
-          if photoid is not None:
-            photoid = photoid.text
-
-          content = {
-            'stat': 'ok',
-            'photoid': photoid
-          }
+        content = self.parse_upload_response(req.read())
 
       else:
         url = self.rest_api_url + '?' + urllib.urlencode(qs)
@@ -314,6 +322,73 @@ class FlickrAPI(object):
 
     return dict(content)
 
+  def prepare_upload(self, files, params=None, replace=False):
+    """Sign the parameters and build the multipart body for uploading the open file files.
+    Returns the url, body and headers of the request."""
+    # To upload/replace file, we need to create a fake request
+    # to sign parameters that are not multipart before we add
+    # the multipart file to the parameters...
+    # OAuth is not meant to sign multipart post data
+    http_url = self.replace_api_url if replace else self.upload_api_url
+    faux_req = oauth.Request.from_consumer_and_token(self.consumer,
+                                                     token=self.token,
+                                                     http_method="POST",
+                                                     http_url=http_url,
+                                                     parameters=params or {})
+
+    faux_req.sign_request(oauth.SignatureMethod_HMAC_SHA1(),
+                          self.consumer,
+                          self.token)
+
+    all_upload_params = dict(parse_qsl(faux_req.to_postdata()))
+
+    # For Tumblr, all media (photos, videos)
+    # are sent with the 'data' parameter
+    all_upload_params['photo'] = (files.name, files)
+    body = MultipartBody(all_upload_params)
+
+    headers = dict(self.headers)
+    headers.update({
+      'Content-Type': body.content_type,
+      'Content-Length': str(len(body))
+    })
+    return http_url, body, headers
+
+  def parse_upload_response(self, content):
+    """Flickr answers uploads with XML. Turn it into the same kind of dict as the JSON API calls."""
+    content = etree.XML(content)
+
+    stat = content.get('stat') or 'ok'
+
+    if stat == 'fail':
+      if content.find('.//err') is not None:
+        code = content.findall('.//err[@code]')
+        msg = content.findall('.//err[@msg]')
+
+        if len(code) > 0:
+          if len(msg) == 0:
+            msg = 'An error occurred making your Flickr API request.'
+          else:
+            msg = msg[0].get('msg')
+
+          code = int(code[0].get('code'))
+
+          content = {
+            'stat': 'fail',
+            'code': code,
+            'message': msg
+          }
+    else:
+      photoid = content.find('.//photoid')
+      if photoid is not None:
+        photoid = photoid.text
+
+      content = {
+        'stat': 'ok',
+        'photoid': photoid
+      }
+    return content
+
   def get(self, endpoint=None, params=None):
     params = params or {}
     return self.api_request(endpoint, method='GET', params=params)
@@ -374,6 +449,232 @@ class FlickrAPI(object):
 
     return body.getvalue(), content_type
 
+class RetryableError(Exception):
+  """An upload failed in a way that may well go away if we try again (server error, Flickr busy)."""
+  pass
+
+class UploadJournal(object):
+  """Remembers, on disk, what we have been asked to upload and what has gone up, so an interrupted pile can be
+  picked up again and nothing is sent twice.
+
+    pending  - files that are 'queued', 'in-flight' or 'failed'. A file is dropped from here once it is uploaded.
+               In-flight files carry the hash of their contents
+    uploaded - the SHA-1 of the contents of every file we have uploaded, with the photo id Flickr gave it
+
+  Files are matched on content, so a copy or a renamed file is not uploaded again, nor uploaded while the same
+  contents are in flight. The hash is only worked out when the path, size and modification time don't match what we
+  uploaded before. Used from the upload threads, so all access goes through a lock. Nothing is in flight when the
+  journal is opened, so files left in flight by an earlier run are put back in the queued state."""
+  def __init__(self, fname):
+    self.fname = fname
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(fname, check_same_thread=False)
+    self.db.executescript('''
+      CREATE TABLE IF NOT EXISTS pending (path TEXT PRIMARY KEY, state TEXT, error TEXT);
+      CREATE TABLE IF NOT EXISTS uploaded (hash TEXT PRIMARY KEY, path TEXT, size INTEGER, mtime REAL, photoid TEXT,
+                                           time REAL);
+      CREATE INDEX IF NOT EXISTS uploaded_path ON uploaded (path);
+    ''')
+    if 'hash' not in [r[1] for r in self.db.execute('PRAGMA table_info(pending)')]:
+      self.db.execute('ALTER TABLE pending ADD COLUMN hash TEXT')
+    self.db.execute("UPDATE pending SET state='queued', hash=NULL WHERE state='in-flight'")
+    self.db.commit()
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+  def set_state(self, fnames, state, error=None):
+    with self.lock:
+      self.db.executemany('INSERT OR REPLACE INTO pending (path, state, error) VALUES (?, ?, ?)',
+                          [(_u(f), state, error) for f in fnames])
+      self.db.commit()
+
+  def unfinished(self):
+    """Files that were queued or in flight when we last stopped."""
+    with self.lock:
+      return [r[0] for r in self.db.execute("SELECT path FROM pending WHERE state IN ('queued', 'in-flight')")]
+
+  def check(self, fname):
+    """Claim fname for uploading. Returns (content hash, state, photo id) where state is
+      'uploaded'  - these contents have been uploaded before, as photo id
+      'in-flight' - the same contents are being uploaded right now (photo id is None). fname is dropped from pending
+      'claimed'   - fname is now in flight and it is up to the caller to upload it (photo id is None)
+    The lookup and the claim are one step under the lock, so two workers can't both claim the same contents."""
+    st = os.stat(fname)
+    with self.lock:
+      row = self.db.execute('SELECT hash, photoid FROM uploaded WHERE path=? AND size=? AND mtime=?',
+                            (_u(fname), st.st_size, st.st_mtime)).fetchone()
+    if row is not None: return row[0], 'uploaded', row[1]
+    digest = file_hash(fname) #Slow, so done outside the lock
+    with self.lock:
+      row = self.db.execute('SELECT photoid FROM uploaded WHERE hash=?', (digest,)).fetchone()
+      if row is not None: return digest, 'uploaded', row[0]
+      row = self.db.execute("SELECT path FROM pending WHERE hash=? AND state='in-flight' AND path!=?",
+                            (digest, _u(fname))).fetchone()
+      if row is not None:
+        self.db.execute('DELETE FROM pending WHERE path=?', (_u(fname),))
+        state = 'in-flight'
+      else:
+        self.db.execute("INSERT OR REPLACE INTO pending (path, state, error, hash) VALUES (?, 'in-flight', NULL, ?)",
+                        (_u(fname), digest))
+        state = 'claimed'
+      self.db.commit()
+    return digest, state, None
+
+  def done(self, fname, digest, photoid):
+    st = os.stat(fname)
+    with self.lock:
+      self.db.execute('INSERT OR REPLACE INTO uploaded VALUES (?, ?, ?, ?, ?, ?)',
+                      (digest, _u(fname), st.st_size, st.st_mtime, photoid, time.time()))
+      self.db.execute('DELETE FROM pending WHERE path=?', (_u(fname),))
+      self.db.commit()
+
+def file_hash(fname, chunk_size=1024 * 1024):
+  h = hashlib.sha1()
+  with open(fname, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+class UploadQueue(object):
+  """Uploads files on a bounded pool of worker threads. Each worker keeps its own HTTP connection open from one
+  upload to the next, and failed uploads are retried with exponential backoff (backoff, 2*backoff, 4*backoff ...
+  seconds). A file that still fails does not hold up the rest.
+
+  status(fname, state, info) is called on the worker threads as files move along. state is one of
+    'uploading', 'retry' (info is the error), 'done' (info is the photo id), 'failed' (info is the error),
+    'skipped' (already uploaded, info is the photo id, or None if the same contents are being uploaded now) and
+    'idle' (fname is None, info is the number of files uploaded since the queue was last idle)
+  The GUI passes in Queue.put and drains the queue from the Tk thread.
+
+  Files that are already waiting in the queue are not added again. If a journal (UploadJournal) is given, progress
+  is recorded in it and files it has seen uploaded are skipped."""
+  def __init__(self, api, status=None, workers=4, retries=4, backoff=1.0, params=None, journal=None):
+    self.api = api
+    self.journal = journal
+    self.status = status or (lambda fname, state, info: None)
+    self.retries = retries
+    self.backoff = backoff
+    self.params = params or {'is_public': 0, 'is_friend': 0, 'is_family': 0}
+    self.queue = Queue.Queue()
+    self.lock = threading.Lock()
+    self.outstanding = 0
+    self.uploaded = 0
+    self.pending = set() #Files added and not yet processed
+    self.threads = []
+    for n in range(workers):
+      t = threading.Thread(target=self.worker, name='upload {:d}'.format(n))
+      t.daemon = True
+      t.start()
+      self.threads.append(t)
+
+  def add(self, fnames):
+    with self.lock:
+      new = []
+      for f in fnames:
+        if f not in self.pending: new.append(f)
+        self.pending.add(f)
+      fnames = new
+      self.outstanding += len(fnames)
+    if self.journal is not None: self.journal.set_state(fnames, 'queued')
+    for f in fnames:
+      self.queue.put(f)
+
+  def close(self):
+    """Let the workers finish what is queued and then stop."""
+    for t in self.threads:
+      self.queue.put(None)
+
+  def connect(self):
+    url = urlparse(self.api.upload_api_url)
+    connection = httplib.HTTPSConnection if url.scheme == 'https' else httplib.HTTPConnection
+    return connection(url.netloc, timeout=120)
+
+  def upload(self, conn, fname):
+    """One attempt at uploading the file over conn. Returns the photo id. The file is streamed from disk as it is
+    sent."""
+    with open(fname, 'rb') as f:
+      url, body, headers = self.api.prepare_upload(f, dict(self.params))
+      conn.request('POST', urlparse(url).path, body, headers)
+    resp = conn.getresponse()
+    content = resp.read() #Have to read it all for the connection to be reusable
+    if resp.status >= 500:
+      raise RetryableError('Flickr returned {:d}'.format(resp.status))
+    if resp.status != 200:
+      raise FlickrAPIError('Flickr returned a Non-200 response.', error_code=resp.status)
+    content = self.api.parse_upload_response(content)
+    if content.get('stat') == 'fail':
+      if content.get('code') == 105: #Service currently unavailable
+        raise RetryableError(content['message'])
+      raise FlickrAPIError(content.get('message', 'Upload failed'), error_code=content.get('code'))
+    return content['photoid']
+
+  def failed(self, fname, error):
+    if self.journal is not None: self.journal.set_state([fname], 'failed', error)
+    self.status(fname, 'failed', error)
+
+  def process(self, conn, fname):
+    """Upload one file, with retries. Returns the connection, which is None if it had to be dropped."""
+    digest = None
+    if self.journal is not None:
+      try:
+        digest, state, photoid = self.journal.check(fname)
+      except (IOError, OSError) as e:
+        self.failed(fname, str(e))
+        return conn
+      if state == 'uploaded': self.journal.done(fname, digest, photoid)
+      if state != 'claimed':
+        self.status(fname, 'skipped', photoid)
+        return conn
+    self.status(fname, 'uploading', None)
+    for attempt in range(self.retries + 1):
+      try:
+        if conn is None: conn = self.connect()
+        photoid = self.upload(conn, fname)
+        with self.lock:
+          self.uploaded += 1
+        if self.journal is not None: self.journal.done(fname, digest, photoid)
+        self.status(fname, 'done', photoid)
+        break
+      except (RetryableError, httplib.HTTPException, socket.error) as e:
+        if conn is not None: conn.close()
+        conn = None
+        if attempt == self.retries:
+          self.failed(fname, str(e))
+        else:
+          self.status(fname, 'retry', str(e))
+          time.sleep(self.backoff * 2 ** attempt)
+      except (FlickrAPIError, IOError) as e: #Not worth retrying
+        self.failed(fname, str(e))
+        break
+    return conn
+
+  def worker(self):
+    conn = None
+    while True:
+      fname = self.queue.get()
+      if fname is None: break
+      try:
+        conn = self.process(conn, fname)
+      except Exception as e: #A bad response or a journal error must not take the worker down with it
+        logger.exception('Uploading {:s}'.format(fname))
+        if conn is not None: conn.close()
+        conn = None
+        try:
+          self.failed(fname, str(e))
+        except Exception:
+          logger.exception('Recording the failure of {:s}'.format(fname))
+      finally:
+        with self.lock:
+          self.pending.discard(fname)
+          self.outstanding -= 1
+          idle = self.outstanding == 0
+          uploaded = self.uploaded
+          if idle: self.uploaded = 0
+      if idle: self.status(None, 'idle', uploaded)
+    if conn is not None: conn.close()
+
 class Fup(FlickrAPI):
   """We make this a class so we can use a single FlickrAPI instance."""
   def setup_authorization(self, new=1):
@@ -398,21 +699,25 @@ class Fup(FlickrAPI):
     logger.debug(final_tokens)
     self.set_state(oauth_token=final_tokens['oauth_token'], oauth_token_secret=final_tokens['oauth_token_secret'])
 
-  def upload_files(self, fnames, callback_func=None):
+  def upload_files(self, fnames, callback_func=None, workers=4, journal=None):
     """Pass in a list of file names for upload. If you pass a callback_func, it will be called as
-    callback_func(msg) with a message every time a file has been uploaded."""
-    callback_func('Preparing to upload {:d} files'.format(len(fnames)))
-    upload_thread = threading.Thread(target=self.threaded_upload, name='Thread', args=(fnames,callback_func))
-    upload_thread.start()
-
-  def threaded_upload(self, fnames, callback_func=None):
-    cnt=0
-    for f in fnames:
-      logger.debug('Uploading {:s}'.format(f))
-      self.post(files=open(f,'rb'), params={'is_public': 0, 'is_friend': 0, 'is_family': 0}) #Returns photo id. Need file object
-      if callback_func: callback_func('Uploaded {:s}'.format(f))
-      cnt += 1
-    if callback_func: callback_func('Finished uploading {:d} photos'.format(cnt))
+    callback_func(msg) with a message every time a file has been uploaded. It is called on the upload threads.
+    With a journal (UploadJournal) files that have already been uploaded are skipped. The journal is only looked at
+    the first time round, when the upload queue is created."""
+    fnames = list(fnames)
+    def _status(fname, state, info):
+      if callback_func is None: return
+      if state == 'done': callback_func('Uploaded {:s}'.format(fname))
+      elif state == 'skipped' and info is None: callback_func('Already uploading {:s}'.format(fname))
+      elif state == 'skipped': callback_func('Already uploaded {:s}'.format(fname))
+      elif state == 'retry': callback_func('Retrying {:s} ({:s})'.format(fname, info))
+      elif state == 'failed': callback_func('Failed to upload {:s}: {:s}'.format(fname, info))
+      elif state == 'idle': callback_func('Finished uploading {:d} photos'.format(info))
+    if callback_func: callback_func('Preparing to upload {:d} files'.format(len(fnames)))
+    if not hasattr(self, 'upload_queue'):
+      self.upload_queue = UploadQueue(self, status=_status, workers=workers, journal=journal)
+    self.upload_queue.status = _status
+    self.upload_queue.add(fnames)
 
 if __name__ == "__main__":
   logging.basicConfig(level=logging.DEBUG)
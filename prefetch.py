@@ -0,0 +1,106 @@
+"""Background prefetching of metadata and thumbnails for the rows around the cursor in the file browser, so that by
+the time the user arrows onto a row its thumbnail and info are already in the caches. LatestWorker does the work for
+the row the cursor is on, off the Tk thread, giving up on rows the cursor has already left.
+"""
+import logging
+logger = logging.getLogger(__name__)
+import threading, Queue
+
+class Prefetcher(object):
+  """A few worker threads that call fetch(finfo) for the files they are given. Every call to prefetch() starts a
+  new generation and jobs left over from older generations are dropped unrun, so the work always follows the
+  cursor. The number of threads bounds how much exiftool/PIL work we do behind the user's back."""
+  def __init__(self, fetch, workers=2):
+    self.fetch = fetch
+    self.queue = Queue.Queue()
+    self.generation = 0
+    self.threads = []
+    for n in range(workers):
+      t = threading.Thread(target=self.run, name='prefetch {:d}'.format(n))
+      t.daemon = True
+      t.start()
+      self.threads.append(t)
+
+  def prefetch(self, file_list):
+    """Replace whatever we were prefetching with these files (most important first)."""
+    self.generation += 1
+    for finfo in file_list:
+      self.queue.put((self.generation, finfo))
+
+  def cancel(self):
+    self.generation += 1
+
+  def close(self):
+    self.cancel()
+    for t in self.threads:
+      self.queue.put(None)
+
+  def run(self):
+    while True:
+      job = self.queue.get()
+      if job is None: return
+      generation, finfo = job
+      if generation != self.generation: continue #Stale
+      try:
+        self.fetch(finfo)
+      except Exception:
+        logger.exception('Prefetching {:s}'.format(finfo[0]))
+
+class LatestWorker(object):
+  """One worker thread that only ever works on the newest job. Jobs that arrive while it is busy replace each other,
+  so after a burst of submits (an arrow key held down) only the last one runs. work(job) is called on the worker
+  thread and its result, unless it is None, is put on the results queue as (generation, result) for the Tk thread to
+  pick up. Inside work, superseded() tells whether a newer job has come in, so long jobs can give up early, and
+  post(result) hands back a partial result straight away."""
+  def __init__(self, work, name='worker'):
+    self.work = work
+    self.queue = Queue.Queue()
+    self.results = Queue.Queue()
+    self.generation = 0 #Of the newest job
+    self.finished = 0 #Generation of the last job we are done with (or gave up on)
+    self.running = None #Generation of the job being worked on
+    self.thread = threading.Thread(target=self.run, name=name)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, job):
+    self.generation += 1
+    self.queue.put((self.generation, job))
+    return self.generation
+
+  def cancel(self):
+    self.generation += 1
+    self.finished = self.generation
+
+  def pending(self):
+    """True until the newest job has been finished."""
+    return self.finished < self.generation
+
+  def superseded(self):
+    return self.running != self.generation
+
+  def post(self, result):
+    generation = self.running
+    if generation == self.generation: self.results.put((generation, result))
+
+  def close(self):
+    self.cancel()
+    self.queue.put(None)
+
+  def run(self):
+    while True:
+      job = self.queue.get()
+      while job is not None and not self.queue.empty(): #Skip straight to the newest job, but not past a close
+        job = self.queue.get_nowait()
+      if job is None: return
+      generation, args = job
+      if generation != self.generation: continue #Stale, a newer job (or a cancel) came along
+      self.running = generation
+      try:
+        result = self.work(args)
+        if result is not None: self.post(result)
+      except Exception:
+        logger.exception('Working on {:s}'.format(str(args)[:200]))
+      finally:
+        self.running = None
+        self.finished = max(self.finished, generation)
@@ -0,0 +1,252 @@
+"""A local search index that answers the same simplified queries as the mdfind backend (see libchhobi.query_map), so
+that searching works where there is no Spotlight and does not wait for Spotlight to catch up.
+
+The index is a SQLite database.
+  photos   - one row per file with the caption, creation date, f-number, exposure time and focal length. The date
+             and numeric columns have their own (sorted) indexes so range queries don't scan the table
+  vocab    - every distinct keyword (field k) and caption word (field c), lower cased
+  postings - (vocab id, photo id) pairs: the inverted index from words to photos
+
+Queries are comparisons joined with && and || and grouped with parentheses, e.g.
+
+  k='rose' && (f<4 || l>=200)
+  c='*fireworks*' && d>$time.iso(2013-06-01)
+
+Strings may use * as a wildcard. = and == mean the same thing.
+"""
+import logging
+logger = logging.getLogger(__name__)
+import re, os, sqlite3, threading
+from libchhobi import to_unicode as _u
+
+class QueryError(Exception):
+  pass
+
+numeric_fields = {'f': 'fnumber', 't': 'exposure', 'l': 'focal'}
+sql_op = {'=': '=', '==': '=', '!=': '!=', '<': '<', '>': '>', '<=': '<=', '>=': '>='}
+
+token_re = re.compile(r"""\s*(?:
+  (?P<paren>[()])|
+  (?P<bool>&&|\|\|)|
+  (?P<tag>\w+)\s*(?P<op>==|!=|<=|>=|=|<|>)\s*
+    (?P<value>'[^']*'\w*|"[^"]*"\w*|\$time\.iso\([^)]*\)|[-+]?[\d.]+(?:/[\d.]+)?)
+  )""", re.VERBOSE)
+word_re = re.compile(r'\w+', re.UNICODE)
+
+def parse_date(value):
+  """exiftool's '2013:06:29 12:00:00' (or an ISO date) -> '2013-06-29 12:00:00', which sorts correctly as text."""
+  value = value.strip()
+  return value[:10].replace(':', '-') + value[10:].replace('T', ' ')
+
+def parse_number(value):
+  """Handles 4.0, '1/250', '50.0 mm' and friends. None if there is nothing numeric."""
+  if isinstance(value, (int, float)): return float(value)
+  value = str(value).split()[0] if len(str(value).split()) else ''
+  try:
+    if '/' in value:
+      num, den = value.split('/')
+      return float(num) / float(den)
+    return float(value)
+  except (ValueError, ZeroDivisionError):
+    return None
+
+def tokenize(query):
+  tokens, pos = [], 0
+  query = query.strip()
+  while pos < len(query):
+    m = token_re.match(query, pos)
+    if m is None or m.end() == pos:
+      raise QueryError('Could not understand the query at "{:s}"'.format(query[pos:]))
+    tokens.append(m)
+    pos = m.end()
+    while pos < len(query) and query[pos].isspace(): pos += 1
+  return tokens
+
+class SearchIndex(object):
+  """All access goes through a lock because indexing and searching can happen on different threads."""
+  def __init__(self, fname):
+    self.fname = fname
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(fname, check_same_thread=False)
+    self.db.executescript('''
+      CREATE TABLE IF NOT EXISTS photos (id INTEGER PRIMARY KEY, path TEXT UNIQUE, caption TEXT, date TEXT,
+                                         fnumber REAL, exposure REAL, focal REAL);
+      CREATE INDEX IF NOT EXISTS photos_date ON photos (date);
+      CREATE INDEX IF NOT EXISTS photos_fnumber ON photos (fnumber);
+      CREATE INDEX IF NOT EXISTS photos_exposure ON photos (exposure);
+      CREATE INDEX IF NOT EXISTS photos_focal ON photos (focal);
+      CREATE TABLE IF NOT EXISTS vocab (id INTEGER PRIMARY KEY, field TEXT, term TEXT, UNIQUE (field, term));
+      CREATE TABLE IF NOT EXISTS postings (vocab INTEGER, photo INTEGER, PRIMARY KEY (vocab, photo));
+      CREATE INDEX IF NOT EXISTS postings_photo ON postings (photo);
+    ''')
+    self.db.commit()
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+  def __len__(self):
+    with self.lock:
+      return self.db.execute('SELECT COUNT(*) FROM photos').fetchone()[0]
+
+  def contains(self, paths):
+    """The subset of paths that are in the index."""
+    paths = dict((_u(p), p) for p in paths)
+    found = set()
+    with self.lock:
+      keys = paths.keys()
+      for n in range(0, len(keys), 500): #sqlite limits the number of parameters in a query
+        chunk = keys[n:n + 500]
+        found.update(paths[r[0]] for r in self.db.execute(
+          'SELECT path FROM photos WHERE path IN ({:s})'.format(','.join('?' * len(chunk))), chunk))
+    return found
+
+  #Maintaining the index --------------------------------------------------------------------------------------------
+
+  def update(self, meta_data):
+    """Add or refresh files from a list of exiftool style metadata dicts (they need the SourceFile key)."""
+    with self.lock:
+      for md in meta_data:
+        if 'SourceFile' not in md: continue
+        path = _u(md['SourceFile'])
+        self._remove(path)
+        caption = md.get('Caption-Abstract')
+        date = md.get('CreateDate')
+        cur = self.db.execute('INSERT INTO photos (path, caption, date, fnumber, exposure, focal) VALUES (?,?,?,?,?,?)',
+          (path, _u(caption) if caption is not None else None, parse_date(_u(date)) if date else None,
+           parse_number(md.get('FNumber')), parse_number(md.get('ShutterSpeed')), parse_number(md.get('FocalLength'))))
+        photo = cur.lastrowid
+        keywords = md.get('Keywords', [])
+        if not isinstance(keywords, list): keywords = [keywords]
+        terms = [('k', _u(k).lower()) for k in keywords]
+        if caption is not None:
+          terms += [('c', w.lower()) for w in word_re.findall(_u(caption))]
+        for field, term in set(terms):
+          self.db.execute('INSERT OR IGNORE INTO vocab (field, term) VALUES (?, ?)', (field, term))
+          self.db.execute('INSERT OR IGNORE INTO postings SELECT id, ? FROM vocab WHERE field=? AND term=?',
+                          (photo, field, term))
+      self.db.commit()
+
+  def remove(self, paths):
+    with self.lock:
+      for path in paths:
+        self._remove(_u(path))
+      self.db.commit()
+
+  def remove_under(self, top):
+    """Remove every file below the directory top (it was deleted or moved away)."""
+    top = _u(os.path.join(top, ''))
+    with self.lock:
+      condition = 'SELECT id FROM photos WHERE substr(path, 1, ?) = ?'
+      self.db.execute('DELETE FROM postings WHERE photo IN ({:s})'.format(condition), (len(top), top))
+      self.db.execute('DELETE FROM photos WHERE id IN ({:s})'.format(condition), (len(top), top))
+      self.db.commit()
+
+  def _remove(self, path):
+    row = self.db.execute('SELECT id FROM photos WHERE path=?', (path,)).fetchone()
+    if row is None: return
+    self.db.execute('DELETE FROM postings WHERE photo=?', row)
+    self.db.execute('DELETE FROM photos WHERE id=?', row)
+
+  def index_files(self, etool, file_list):
+    """Pull metadata for the files (a list of (path, type) as used everywhere else) through exiftool and index it."""
+    self.update(etool.get_metadata_for_files(file_list))
+
+  #Searching --------------------------------------------------------------------------------------------------------
+
+  def search(self, query, root='./'):
+    """Return the paths under root matching the query, sorted."""
+    sql, params = compile_query(query)
+    root = _u(os.path.join(os.path.abspath(root), ''))
+    sql = 'SELECT path FROM photos WHERE substr(path, 1, ?) = ? AND ({:s}) ORDER BY path'.format(sql)
+    logger.debug(sql)
+    with self.lock:
+      return [r[0] for r in self.db.execute(sql, [len(root), root] + params)]
+
+def compile_query(query):
+  """Translate a query into a SQL condition on the photos table. Returns the condition and its parameters."""
+  return QueryCompiler(tokenize(query)).compile()
+
+class QueryCompiler(object):
+  """A small recursive descent parser. || binds looser than &&."""
+  def __init__(self, tokens):
+    self.tokens = tokens
+    self.pos = 0
+
+  def compile(self):
+    if not len(self.tokens): raise QueryError('Empty query')
+    sql, params = self.expr()
+    if self.pos != len(self.tokens):
+      raise QueryError('Unexpected {:s}'.format(self.tokens[self.pos].group(0).strip()))
+    return sql, params
+
+  def expr(self):
+    return self.join('||', 'OR', self.term)
+
+  def term(self):
+    return self.join('&&', 'AND', self.factor)
+
+  def join(self, symbol, sql_symbol, operand):
+    sql, params = operand()
+    while self.pos < len(self.tokens) and self.tokens[self.pos].group('bool') == symbol:
+      self.pos += 1
+      rhs, rhs_params = operand()
+      sql, params = '({:s}) {:s} ({:s})'.format(sql, sql_symbol, rhs), params + rhs_params
+    return sql, params
+
+  def factor(self):
+    if self.pos >= len(self.tokens): raise QueryError('Query ends too soon')
+    tok = self.tokens[self.pos]
+    self.pos += 1
+    if tok.group('paren') == '(':
+      sql, params = self.expr()
+      if self.pos >= len(self.tokens) or self.tokens[self.pos].group('paren') != ')': raise QueryError('Missing )')
+      self.pos += 1
+      return sql, params
+    if tok.group('tag') is None:
+      raise QueryError('Unexpected {:s}'.format(tok.group(0).strip()))
+    return self.comparison(tok.group('tag'), tok.group('op'), tok.group('value'))
+
+  def comparison(self, tag, op, value):
+    op = sql_op[op]
+    if value.startswith('$time.iso('):
+      value = value[len('$time.iso('):-1]
+    elif value[0] in '\'"':
+      value = value[1:value.rindex(value[0])] #Drop the quotes and any mdfind modifiers (cdw) after them
+    if tag in numeric_fields:
+      number = parse_number(value)
+      if number is None: raise QueryError('{:s} needs a number'.format(tag))
+      return '{:s} {:s} ?'.format(numeric_fields[tag], op), [number]
+    if tag == 'd':
+      date = parse_date(value)
+      if op in ['=', '!='] and len(date) <= 10: #A whole day
+        return '{:s}date GLOB ?'.format('NOT ' if op == '!=' else ''), [date + '*']
+      return 'date {:s} ?'.format(op), [date]
+    if tag in ['k', 'c']:
+      if op not in ['=', '!=']: raise QueryError('{:s} can only be compared with = or !='.format(tag))
+      sql, params = self.text_match(tag, _u(value).lower())
+      return ('NOT ' if op == '!=' else '') + sql, params
+    raise QueryError('Unknown search field {:s}'.format(tag))
+
+  def text_match(self, tag, pattern):
+    """Keywords, and caption patterns of the form *word*, are looked up in the inverted index. Other caption
+    patterns are matched against the caption text, like mdfind does."""
+    word = pattern[1:-1] if len(pattern) > 2 and pattern[0] == '*' and pattern[-1] == '*' else None
+    if tag == 'k' or (word and word_re.match(word) and word_re.match(word).end() == len(word)):
+      cmp = 'GLOB' if '*' in pattern else '='
+      return ('id IN (SELECT photo FROM postings WHERE vocab IN '
+              '(SELECT id FROM vocab WHERE field=? AND term {:s} ?))'.format(cmp)), [tag, pattern]
+    if '*' in pattern:
+      return 'lower(caption) GLOB ?', [pattern]
+    return 'lower(caption) = ?', [pattern]
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument('index', help='Index database file')
+  parser.add_argument('query', help='Query to run')
+  parser.add_argument('-r', default='./', help='Only return files under this directory')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.DEBUG)
+  for path in SearchIndex(args.index).search(args.query, args.r):
+    print path
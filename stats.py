@@ -0,0 +1,153 @@
+"""Latency and counter instrumentation for the hot paths, cheap enough to leave on all the time.
+
+  with stats.timed('resize_image'):
+    ...
+  stats.record('exiftool', seconds, n_bytes)
+  stats.count('thumbnail cache miss')
+
+Each named operation gets a call count, a byte count and a latency histogram with logarithmic buckets (ten per
+decade from 10us to 100s), so recording is a bisect and an increment and the memory use is fixed however long
+Chhobi runs. Percentiles read off the histogram are accurate to a bucket (about 25%). Gauges are callables that
+are sampled when a snapshot is taken, which is how existing counters (e.g. the caches' hits and misses) are
+reported without counting twice.
+
+Everything goes into the module level registry. report() formats it for people and snapshot() for machines;
+JsonDumper writes a snapshot to a file every so often for monitoring.
+"""
+import logging
+logger = logging.getLogger(__name__)
+import os, time, json, bisect, threading, contextlib
+
+class Histogram(object):
+  bounds = [1e-5 * 10 ** (k / 10.0) for k in range(71)] #Upper bucket edges, 10us ... 100s
+
+  def __init__(self):
+    self.counts = [0] * (len(self.bounds) + 1) #The last bucket is for anything over 100s
+    self.n = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, seconds):
+    self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+    self.n += 1
+    self.total += seconds
+    if seconds > self.max: self.max = seconds
+
+  def percentile(self, p):
+    """The upper edge of the bucket the p-th percentile falls in (never more than the largest value seen)."""
+    if self.n == 0: return 0.0
+    rank = p / 100.0 * self.n
+    seen = 0
+    for k, c in enumerate(self.counts):
+      seen += c
+      if seen >= rank and c:
+        return min(self.bounds[k], self.max) if k < len(self.bounds) else self.max
+    return self.max
+
+class Stats(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.histograms = {}
+    self.n_bytes = {}
+    self.counters = {}
+    self.gauges = {}
+    self.started = time.time()
+
+  def record(self, name, seconds, n_bytes=None):
+    with self.lock:
+      h = self.histograms.get(name)
+      if h is None: h = self.histograms[name] = Histogram()
+      h.add(seconds)
+      if n_bytes is not None: self.n_bytes[name] = self.n_bytes.get(name, 0) + n_bytes
+
+  @contextlib.contextmanager
+  def timed(self, name):
+    t0 = time.time()
+    try:
+      yield
+    finally:
+      self.record(name, time.time() - t0)
+
+  def count(self, name, n=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def gauge(self, name, func):
+    """Report func() under name whenever a snapshot is taken."""
+    self.gauges[name] = func
+
+  def reset(self):
+    with self.lock:
+      self.histograms, self.n_bytes, self.counters = {}, {}, {}
+      self.started = time.time()
+
+  def snapshot(self):
+    with self.lock:
+      operations = {}
+      for name, h in self.histograms.iteritems():
+        operations[name] = {
+          'calls': h.n,
+          'total_s': h.total,
+          'mean_s': h.total / h.n,
+          'p50_s': h.percentile(50),
+          'p95_s': h.percentile(95),
+          'p99_s': h.percentile(99),
+          'max_s': h.max
+        }
+        if name in self.n_bytes: operations[name]['bytes'] = self.n_bytes[name]
+      counters = dict(self.counters)
+    for name, func in self.gauges.items():
+      try:
+        counters[name] = func()
+      except Exception:
+        logger.exception('Reading gauge {:s}'.format(name))
+    return {'time': time.time(), 'uptime_s': time.time() - self.started, 'operations': operations,
+            'counters': counters}
+
+  def report(self):
+    snap = self.snapshot()
+    lines = ['{:<24s}{:>8s}{:>10s}{:>10s}{:>10s}{:>10s}'.format('operation', 'calls', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                                  'max ms')]
+    for name, op in sorted(snap['operations'].items()):
+      lines.append('{:<24s}{:>8d}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+        name, op['calls'], op['p50_s'] * 1e3, op['p95_s'] * 1e3, op['p99_s'] * 1e3, op['max_s'] * 1e3))
+    if len(snap['counters']):
+      lines.append('')
+      lines += ['{:<24s}{:>8d}'.format(name, value) for name, value in sorted(snap['counters'].items())]
+    return '\n'.join(lines)
+
+class JsonDumper(object):
+  """Writes registry.snapshot() to fname every interval seconds from a daemon thread. The file is replaced in one
+  go (write then rename) so a reader never sees half a snapshot."""
+  def __init__(self, fname, interval=60, stats=None):
+    self.fname = fname
+    self.interval = interval
+    self.stats = stats or registry
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.run, name='stats dump')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def close(self):
+    self.stopped.set()
+    self.thread.join()
+    self.dump()
+
+  def dump(self):
+    tmp = self.fname + '.tmp'
+    try:
+      with open(tmp, 'w') as f:
+        json.dump(self.stats.snapshot(), f, indent=2, sort_keys=True)
+      os.rename(tmp, self.fname)
+    except (IOError, OSError) as e:
+      logger.warning('Could not write stats to {:s}: {:s}'.format(self.fname, str(e)))
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      self.dump()
+
+registry = Stats()
+record = registry.record
+timed = registry.timed
+count = registry.count
+gauge = registry.gauge
@@ -0,0 +1,53 @@
+"""Virtual listings in DirBrowse. Needs a display; skipped without one.
+
+python -m unittest test_dirbrowser
+"""
+import unittest, Tkinter as tki
+import dirbrowser
+
+class VirtualListingTest(unittest.TestCase):
+  def setUp(self):
+    try:
+      self.root = tki.Tk()
+    except tki.TclError:
+      raise unittest.SkipTest('No display')
+    self.browser = dirbrowser.DirBrowse(self.root, window_size=40)
+    self.browser.pack(expand=True, fill='both')
+
+  def tearDown(self):
+    self.root.destroy()
+
+  def stream(self, paths, chunk=25):
+    self.browser.virtual_flat([], title='Search results')
+    for n in range(0, len(paths), chunk):
+      self.browser.virtual_append(paths[n:n + chunk])
+      self.root.update()
+
+  def test_append_keeps_window(self):
+    paths = ['/photos/{:04d}.jpg'.format(n) for n in range(400)]
+    self.stream(paths + paths[:3]) #Duplicates are dropped, not an error
+    tv = self.browser.treeview
+    self.assertEqual(self.browser.virtual_rows[1:401], paths)
+    self.assertTrue(len(tv.get_children()) <= self.browser.window_size)
+
+  def test_scroll_and_select(self):
+    paths = ['/photos/{:04d}.jpg'.format(n) for n in range(400)]
+    self.stream(paths)
+    tv = self.browser.treeview
+    tv.selection_set(paths[5])
+    self.browser.yview('moveto', 0.5)
+    self.root.update()
+    self.assertTrue(self.browser.window_start > 0)
+    shown = tv.get_children()
+    self.assertEqual(list(shown), self.browser.virtual_rows[self.browser.window_start:
+                                                           self.browser.window_start + len(shown)])
+    self.assertIn(paths[5], [v[0] for v in self.browser.file_selection()]) #Scrolled out but still selected
+    tv.selection_add(shown[len(shown) // 2])
+    self.assertEqual(len(self.browser.file_selection()), 2)
+    self.browser.yview('moveto', 0.0)
+    self.root.update()
+    self.assertEqual(tv.item(tv.get_children()[0])['values'][0], 'title')
+    self.assertEqual(len(self.browser.file_selection()), 2)
+
+if __name__ == '__main__':
+  unittest.main()
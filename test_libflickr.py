@@ -0,0 +1,118 @@
+"""Runs the UploadQueue against a stand-in Flickr upload server on localhost.
+
+python -m unittest test_libflickr
+"""
+import os, shutil, tempfile, threading, unittest, Queue, BaseHTTPServer, SocketServer
+import libflickr
+
+class StubUploadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1' #Keep-alive, like Flickr
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers['Content-Length']))
+    with self.server.lock:
+      self.server.requests.append(body)
+      status = self.server.responses.pop(0) if len(self.server.responses) else 200
+      self.server.photoid += 1
+      photoid = self.server.photoid
+    content = '<rsp stat="ok"><photoid>{:d}</photoid></rsp>'.format(photoid) if status == 200 else 'Busy'
+    self.send_response(status)
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def log_message(self, *args):
+    pass
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True #Each upload worker holds a connection open
+
+class StubAPI(libflickr.FlickrAPI):
+  """Skips the OAuth signing, everything else is as for Flickr."""
+  def prepare_upload(self, files, params=None, replace=False):
+    body = libflickr.MultipartBody(dict(params or {}, photo=(files.name, files)))
+    return self.upload_api_url, body, {'Content-Type': body.content_type, 'Content-Length': str(len(body))}
+
+class UploadQueueTest(unittest.TestCase):
+  def setUp(self):
+    self.server = StubServer(('127.0.0.1', 0), StubUploadHandler)
+    self.server.lock = threading.Lock()
+    self.server.requests = []
+    self.server.responses = []
+    self.server.photoid = 0
+    self.server_thread = threading.Thread(target=self.server.serve_forever)
+    self.server_thread.daemon = True
+    self.server_thread.start()
+    self.api = StubAPI(headers={'User-agent': 'Chhobi'})
+    self.api.upload_api_url = 'http://127.0.0.1:{:d}/upload/'.format(self.server.server_address[1])
+    self.dir = tempfile.mkdtemp()
+    self.journal = libflickr.UploadJournal(os.path.join(self.dir, 'uploads.sqlite'))
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.journal.close()
+    shutil.rmtree(self.dir)
+
+  def photo(self, name, contents):
+    fname = os.path.join(self.dir, name)
+    with open(fname, 'wb') as f:
+      f.write(contents)
+    return fname
+
+  def upload(self, fnames, workers=2):
+    """Upload fnames and return the (fname, state, info) messages up to the queue going idle."""
+    messages = Queue.Queue()
+    queue = libflickr.UploadQueue(self.api, status=lambda *m: messages.put(m), workers=workers, backoff=0.01,
+                                  journal=self.journal)
+    queue.add(fnames)
+    seen = []
+    while True:
+      m = messages.get(timeout=10)
+      seen.append(m)
+      if m[1] == 'idle': break
+    queue.close()
+    return seen
+
+  def test_upload(self):
+    fnames = [self.photo('{:d}.jpg'.format(n), 'photo {:d}'.format(n)) for n in range(3)]
+    seen = self.upload(fnames)
+    self.assertEqual(sorted(m[0] for m in seen if m[1] == 'done'), sorted(fnames))
+    self.assertEqual(seen[-1], (None, 'idle', 3))
+    self.assertEqual(len(self.server.requests), 3)
+    self.assertTrue(all('photo ' in body for body in self.server.requests))
+    self.assertEqual(self.journal.unfinished(), [])
+
+  def test_retry_on_server_error(self):
+    self.server.responses = [503, 500]
+    fname = self.photo('a.jpg', 'photo a')
+    seen = self.upload([fname], workers=1)
+    self.assertEqual([m[1] for m in seen], ['uploading', 'retry', 'retry', 'done', 'idle'])
+    self.assertEqual(len(self.server.requests), 3)
+
+  def test_skip_duplicates(self):
+    first = self.photo('a.jpg', 'same contents')
+    self.upload([first])
+    copy = self.photo('copy of a.jpg', 'same contents')
+    seen = self.upload([first, copy])
+    self.assertEqual(sorted((m[0], m[1]) for m in seen if m[0] is not None),
+                     sorted([(first, 'skipped'), (copy, 'skipped')]))
+    self.assertEqual(len(self.server.requests), 1)
+
+  def test_same_contents_at_once(self):
+    fnames = [self.photo('{:d}.jpg'.format(n), 'same contents') for n in range(4)]
+    seen = self.upload(fnames + fnames, workers=4)
+    self.assertEqual(len(self.server.requests), 1)
+    self.assertEqual(len([m for m in seen if m[1] in ('done', 'skipped')]), 4)
+
+  def test_bad_response(self):
+    """A garbled answer fails the file but leaves the workers running."""
+    self.api.parse_upload_response = lambda content: None.get('stat') #Raises AttributeError
+    fname = self.photo('a.jpg', 'photo a')
+    seen = self.upload([fname], workers=1)
+    self.assertEqual([m[1] for m in seen], ['uploading', 'failed', 'idle'])
+    del self.api.parse_upload_response
+    seen = self.upload([fname], workers=1)
+    self.assertEqual([m[1] for m in seen], ['uploading', 'done', 'idle'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,44 @@
+"""Making the thumbnails shown in the thumbnail pane. Used by the GUI and by the warm-up tool, so both produce (and
+cache) exactly the same images.
+"""
+import logging
+logger = logging.getLogger(__name__)
+from cStringIO import StringIO
+from PIL import Image
+import stats, exifreader
+
+thumbnail_size = (150, 150)
+
+def resize_image(img, size, orientation):
+  """The transpose is a fairly cheap operation, so we don't bother to resize before we transpose. PIL decodes
+  lazily, so the time recorded for this includes decoding the image."""
+  with stats.timed('resize_image'):
+    if orientation == 3: img = img.transpose(Image.ROTATE_180)
+    elif orientation == 6: img = img.transpose(Image.ROTATE_270)
+    elif orientation == 8: img = img.transpose(Image.ROTATE_90)
+    img.thumbnail(size, Image.ANTIALIAS)
+  return img
+
+def photo_thumbnail(fname, im_data, orientation):
+  """im_data is the embedded thumbnail exifreader or exiftool found (may be empty). Returns the oriented, resized
+  PIL image."""
+  if len(im_data):
+    thumbnail = Image.open(StringIO(im_data)) #For raws this may be a big preview
+  else:
+    logger.debug('No embedded thumnail for {:s}. Generating on the fly.'.format(fname))
+    #Slow process of generating thumbnail on the fly
+    thumbnail = Image.open(fname)
+  if thumbnail.format == 'JPEG': thumbnail.draft('RGB', thumbnail_size)
+  return resize_image(thumbnail, thumbnail_size, orientation)
+
+def video_thumbnail(thumb_data):
+  """thumb_data is what the VideoThumbnailer returned. None if there is no thumbnail."""
+  return Image.open(StringIO(thumb_data)) if len(thumb_data) else None
+
+def make_thumbnail(etool, video_thumbnailer, finfo, orientation=None):
+  """Return the thumbnail for finfo as a PIL image, or None if we can't make one. The orientation read from the file
+  along with the thumbnail is used if there is one, otherwise the orientation passed in (from the metadata)."""
+  if finfo[1] == 'file:video':
+    return video_thumbnail(video_thumbnailer.get(finfo[0]))
+  im_data, file_orientation = exifreader.read_thumbnail(etool, finfo[0])
+  return photo_thumbnail(finfo[0], im_data, file_orientation if file_orientation is not None else orientation)
@@ -0,0 +1,151 @@
+"""Fills Chhobi's caches for a whole photo library ahead of time, so the first look at a folder is as quick as any
+later one. Schedule it overnight after an import:
+
+python warmup.py [-r root] [-b batch] [-d]
+
+For every photo and video under the photo root it extracts the metadata (into the metadata cache and the search
+index) and makes the thumbnail (into the thumbnail cache, with ffmpeg for videos). Metadata is read in batches
+sharded over the exiftool workers, and thumbnails are pulled through all of them at once. Files that are already
+in every cache are skipped, so an interrupted run can simply be started again and carries on where it stopped.
+
+The photo root, cache directory and worker counts are read from ~/chhobi2.cfg, as for the GUI. When it finishes
+it prints a JSON report of what it did and the throughput in files/s.
+
+The same warm-up can be run from the command window with the w command.
+"""
+import logging
+logger = logging.getLogger(__name__)
+import os, time, json, argparse, ConfigParser
+from os.path import join, expanduser, exists
+import libchhobi as lch, exiftool, exifreader, cache, searchindex, watcher
+from thumbnails import photo_thumbnail, video_thumbnail
+
+class WarmUp(object):
+  """Warms the caches for the media files under a directory. run() blocks, so the GUI calls it on a thread.
+  progress(stats) is called after every batch with the running totals (see stats()) and cancel() stops the run
+  once the current batch is done."""
+  def __init__(self, etool, metadata_cache, thumbnail_cache, search_index, video_thumbnailer,
+               ext_map=lch.default_ext_map, batch=512, progress=None):
+    self.etool = etool
+    self.metadata_cache = metadata_cache
+    self.thumbnail_cache = thumbnail_cache
+    self.search_index = search_index
+    self.video_thumbnailer = video_thumbnailer
+    self.ext_map = ext_map
+    self.batch = batch
+    self.progress = progress or (lambda stats: None)
+    self.cancelled = False
+    self.total = 0
+    self.done = 0 #Files we did work for
+    self.skipped = 0 #Files that were already warm
+    self.errors = 0
+    self.t0 = None
+
+  def cancel(self):
+    self.cancelled = True
+
+  def stats(self):
+    elapsed = time.time() - self.t0 if self.t0 is not None else 0.0
+    return {
+      'total': self.total,
+      'done': self.done,
+      'skipped': self.skipped,
+      'errors': self.errors,
+      'cancelled': self.cancelled,
+      'seconds': elapsed,
+      'files_per_s': self.done / elapsed if elapsed > 0 else 0.0
+    }
+
+  def run(self, root):
+    self.t0 = time.time()
+    file_list = [(p, lch.media_type(p, self.ext_map)) for p in watcher.walk_files(os.path.abspath(root))]
+    file_list = [fi for fi in file_list if fi[1] is not None]
+    self.total = len(file_list)
+    logger.info('Warming up {:d} files under {:s}'.format(self.total, root))
+    for n in range(0, len(file_list), self.batch):
+      if self.cancelled: break
+      self.warm_batch(file_list[n:n + self.batch])
+      self.progress(self.stats())
+    return self.stats()
+
+  def cold_files(self, batch):
+    """The files in the batch that are missing from at least one cache. (Video metadata is not cached.)"""
+    paths = [fi[0] for fi in batch]
+    fresh = self.metadata_cache.get(paths)
+    indexed = self.search_index.contains(paths)
+    return [fi for fi in batch if not ((fi[0] in fresh or fi[1] == 'file:video') and fi[0] in indexed and
+                                       self.thumbnail_cache.has(fi[0]))]
+
+  def warm_batch(self, batch):
+    cold = self.cold_files(batch)
+    self.skipped += len(batch) - len(cold)
+    if not len(cold): return
+    meta_data = self.etool.get_metadata_for_files(cold)
+    self.search_index.update(meta_data)
+    orientations = dict((md.get('SourceFile'), md.get('Orientation')) for md in meta_data)
+    need_thumbnail = [fi for fi in cold if not self.thumbnail_cache.has(fi[0])]
+    videos = self.video_thumbnailer.generate([fi[0] for fi in need_thumbnail if fi[1] == 'file:video'])
+    in_flight = []
+    for fi in need_thumbnail:
+      if self.cancelled: return #The rest are picked up next time
+      if fi[1] != 'file:photo': continue
+      future, orientation = exifreader.read_thumbnail(self.etool, fi[0], block=False)
+      if orientation is None: orientation = orientations.get(fi[0])
+      if future.done(): #Read straight from the file. Made now, as the result holds the file open (mmap)
+        self.store(fi[0], lambda: photo_thumbnail(fi[0], future.result(), orientation))
+      else: #exiftool futures are all put in flight at once, over all the workers
+        in_flight.append((fi[0], future, orientation))
+    for fname, future, orientation in in_flight:
+      if self.cancelled: return
+      self.store(fname, lambda: photo_thumbnail(fname, future.result(), orientation))
+    for fname, thumb_data in videos:
+      self.store(fname, lambda: video_thumbnail(thumb_data))
+    self.done += len(cold)
+
+  def store(self, fname, make):
+    try:
+      thumbnail = make()
+    except Exception as e: #PIL raises all sorts (SyntaxError, ValueError, struct.error ...) on damaged images
+      logger.warning('No thumbnail for {:s}: {:s}'.format(fname, str(e)))
+      thumbnail = None
+    if thumbnail is None:
+      self.errors += 1
+    else:
+      self.thumbnail_cache.put(fname, thumbnail)
+
+def log_progress(stats):
+  logger.info('{done:d} warmed, {skipped:d} already warm of {total:d} ({files_per_s:.1f} files/s)'.format(**stats))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument('-r', help='Photo root to warm up (default: the root in ~/chhobi2.cfg)')
+  parser.add_argument('-b', default=512, type=int, help='Files per batch')
+  parser.add_argument('-d', default=False, action='store_true', help='Print debugging messages')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.DEBUG if args.d else logging.INFO)
+
+  config = ConfigParser.ConfigParser({'root': './', 'cache dir': '~/.chhobi2', 'exiftool workers': '0',
+                                      'thumbnail cache MB': '64', 'video thumbnail workers': '2'})
+  config.read(expanduser('~/chhobi2.cfg'))
+  cache_dir = expanduser(config.get('DEFAULT', 'cache dir'))
+  if not exists(cache_dir): os.makedirs(cache_dir)
+  metadata_cache = cache.MetadataCache(join(cache_dir, 'metadata.sqlite'))
+  thumbnail_cache = cache.ThumbnailCache(join(cache_dir, 'thumbnails.pack'),
+                                         max_bytes=config.getint('DEFAULT', 'thumbnail cache MB') * 1024 * 1024)
+  search_index = searchindex.SearchIndex(join(cache_dir, 'search.sqlite'))
+  etool = exiftool.ExifToolPool(workers=config.getint('DEFAULT', 'exiftool workers'), cache=metadata_cache)
+  video_thumbnailer = lch.VideoThumbnailer(workers=config.getint('DEFAULT', 'video thumbnail workers'))
+  warm_up = WarmUp(etool, metadata_cache, thumbnail_cache, search_index, video_thumbnailer, batch=args.b,
+                   progress=log_progress)
+  try:
+    report = warm_up.run(args.r or config.get('DEFAULT', 'root'))
+  except KeyboardInterrupt:
+    warm_up.cancel()
+    report = warm_up.stats()
+  finally:
+    video_thumbnailer.close()
+    etool.close()
+    metadata_cache.close()
+    thumbnail_cache.close()
+    search_index.close()
+  print json.dumps(report, indent=2, sort_keys=True)
@@ -0,0 +1,248 @@
+"""Keeps the search index and metadata cache in step with the photo root without rescanning it.
+
+A Watcher follows file system events under the root, coalesces them (the last event for a path wins), waits for
+things to go quiet and then hands them on in small batches. On Linux events come from inotify (through ctypes, no
+extra packages needed). Elsewhere we fall back to polling, which stats the tree every so often but still only
+re-extracts the files that changed. We also fall back to polling if inotify can't be set up or the tree has more
+directories than the inotify watch limit (fs.inotify.max_user_watches) allows.
+
+IndexUpdater is the usual consumer: it re-reads metadata for changed files through exiftool and updates the index.
+"""
+import logging
+logger = logging.getLogger(__name__)
+import os, sys, errno, time, struct, select, threading, collections, ctypes, ctypes.util
+import libchhobi as lch
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+watch_mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF)
+
+def walk_files(top):
+  """All the files under top."""
+  for dirpath, dirnames, filenames in os.walk(top):
+    for f in filenames:
+      yield os.path.join(dirpath, f)
+
+class WatchLimitError(OSError):
+  """Raised when inotify runs out of watches (ENOSPC from inotify_add_watch)."""
+  pass
+
+class InotifySource(object):
+  """Recursive inotify watch on a directory tree. events() returns a list of (kind, path) where kind is 'changed',
+  'deleted' or 'deleted dir'. Raises OSError if inotify can't be set up or the tree needs more watches than we are
+  allowed. If a directory added later takes us over the limit, exhausted is set and the Watcher switches to polling."""
+  event_header = struct.Struct('iIII')
+  exhausted = False
+
+  def __init__(self, root, cancelled=lambda: False):
+    self.cancelled = cancelled #Checked while walking the tree, so a slow start can be cut short
+    self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self.fd = self.libc.inotify_init()
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init failed')
+    self.wd_to_dir = {}
+    try:
+      self.add_tree(root)
+    except OSError:
+      self.close()
+      raise
+
+  @staticmethod
+  def available():
+    return sys.platform.startswith('linux') and ctypes.util.find_library('c') is not None
+
+  def close(self):
+    os.close(self.fd)
+
+  def add_watch(self, path):
+    wd = self.libc.inotify_add_watch(self.fd, path, watch_mask)
+    if wd < 0:
+      err = ctypes.get_errno()
+      if err == errno.ENOSPC:
+        raise WatchLimitError(err, 'Ran out of inotify watches at {:s}'.format(path))
+      logger.warning('Could not watch {:s} (errno {:d})'.format(path, err))
+    else:
+      self.wd_to_dir[wd] = path
+
+  def remove_tree(self, top):
+    """Stop watching top and everything under it. Used when a directory is moved, as the watches follow it and would
+    go on reporting the old paths. If it moved within the tree IN_MOVED_TO watches it again under the new path."""
+    for wd, path in self.wd_to_dir.items():
+      if path == top or path.startswith(top + os.sep):
+        del self.wd_to_dir[wd]
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+  def add_tree(self, top):
+    for dirpath, dirnames, filenames in os.walk(top):
+      if self.cancelled(): return
+      self.add_watch(dirpath)
+
+  def events(self, timeout):
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return []
+    data = os.read(self.fd, 64 * 1024)
+    events, pos = [], 0
+    while pos < len(data):
+      wd, mask, cookie, name_len = self.event_header.unpack_from(data, pos)
+      pos += self.event_header.size
+      name = data[pos:pos + name_len].rstrip('\0')
+      pos += name_len
+      if mask & IN_Q_OVERFLOW:
+        logger.warning('inotify queue overflowed, some changes were missed')
+        continue
+      if mask & IN_IGNORED:
+        self.wd_to_dir.pop(wd, None)
+        continue
+      if mask & IN_MOVE_SELF: #Only still mapped if we didn't see it go (e.g. the root itself was moved)
+        if wd in self.wd_to_dir: self.remove_tree(self.wd_to_dir[wd])
+        continue
+      if wd not in self.wd_to_dir or not name: continue
+      path = os.path.join(self.wd_to_dir[wd], name)
+      if mask & IN_ISDIR:
+        if mask & (IN_CREATE | IN_MOVED_TO): #New directory - watch it and pick up anything already in it
+          try:
+            if not self.exhausted: self.add_tree(path)
+          except WatchLimitError as e:
+            logger.warning(str(e))
+            self.exhausted = True
+          events += [('changed', p) for p in walk_files(path)]
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+          if mask & IN_MOVED_FROM: self.remove_tree(path)
+          events.append(('deleted dir', path))
+      elif mask & (IN_DELETE | IN_MOVED_FROM):
+        events.append(('deleted', path))
+      elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB): #IN_CREATE is followed by IN_CLOSE_WRITE
+        events.append(('changed', path))
+    return events
+
+class PollingSource(object):
+  """Stats the tree every interval seconds and reports what differs from the last look."""
+  exhausted = False
+
+  def __init__(self, root, interval=300, cancelled=lambda: False):
+    self.root = root
+    self.interval = interval
+    self.cancelled = cancelled
+    self.snapshot = self.scan()
+    self.last_scan = time.time()
+
+  def close(self):
+    pass
+
+  def scan(self):
+    snapshot = {}
+    for path in walk_files(self.root):
+      if self.cancelled(): break
+      try:
+        st = os.stat(path)
+      except OSError:
+        continue
+      snapshot[path] = (st.st_size, st.st_mtime, st.st_ino)
+    return snapshot
+
+  def events(self, timeout):
+    wait = self.last_scan + self.interval - time.time()
+    if wait > 0:
+      time.sleep(min(wait, timeout))
+      return []
+    snapshot = self.scan()
+    self.last_scan = time.time()
+    events = [('deleted', p) for p in self.snapshot if p not in snapshot]
+    events += [('changed', p) for p, ident in snapshot.iteritems() if self.snapshot.get(p) != ident]
+    self.snapshot = snapshot
+    return events
+
+class Watcher(object):
+  """Runs a source on a background thread. Events are coalesced per path and passed on as
+  on_batch(changed, deleted, deleted_dirs) once nothing has happened for debounce seconds, at most max_batch paths
+  at a time. on_batch is called on the watcher thread. Setting up the source (which walks the whole tree) happens on
+  the watcher thread too, so starting a Watcher returns at once. close() stops the walk if it is still going and
+  only waits a moment for the thread, which closes the source on its way out."""
+  def __init__(self, root, on_batch, debounce=2.0, max_batch=200, method='auto', poll_interval=300):
+    self.root = os.path.abspath(root)
+    self.on_batch = on_batch
+    self.debounce = debounce
+    self.max_batch = max_batch
+    self.method = method
+    self.poll_interval = poll_interval
+    self.source = None
+    self.running = True
+    self.thread = threading.Thread(target=self.run, name='watcher')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def close(self, timeout=1.0):
+    self.running = False
+    self.thread.join(timeout)
+    if self.thread.is_alive(): logger.debug('Watcher still busy, leaving it to finish on its own')
+
+  def start_source(self):
+    cancelled = lambda: not self.running
+    if self.method == 'inotify' or (self.method == 'auto' and InotifySource.available()):
+      return InotifySource(self.root, cancelled)
+    return PollingSource(self.root, self.poll_interval, cancelled)
+
+  def run(self):
+    try:
+      self.source = self.start_source()
+    except OSError as e:
+      logger.warning('Could not watch {:s} with inotify ({:s}), polling instead'.format(self.root, e.strerror))
+      self.source = PollingSource(self.root, self.poll_interval, lambda: not self.running)
+    try:
+      self.watch()
+    finally:
+      self.source.close()
+
+  def watch(self):
+    pending = collections.OrderedDict() #path -> kind
+    last_event = 0
+    while self.running:
+      events = self.source.events(timeout=min(self.debounce, 1.0))
+      for kind, path in events:
+        pending.pop(path, None)
+        pending[path] = kind
+      if len(events): last_event = time.time()
+      if self.source.exhausted: #Changes in the directories inotify couldn't take on are only seen by polling
+        logger.warning('Out of inotify watches under {:s}, polling instead'.format(self.root))
+        self.source.close()
+        self.source = PollingSource(self.root, self.poll_interval, lambda: not self.running)
+      if len(pending) and time.time() - last_event >= self.debounce:
+        while len(pending) and self.running:
+          batch = [pending.popitem(last=False) for n in range(min(self.max_batch, len(pending)))]
+          try:
+            self.on_batch([p for p, k in batch if k == 'changed'],
+                          [p for p, k in batch if k == 'deleted'],
+                          [p for p, k in batch if k == 'deleted dir'])
+          except Exception:
+            logger.exception('Updating after file changes')
+
+class IndexUpdater(object):
+  """Re-extracts metadata for changed photos and videos and refreshes the search index (and metadata cache)."""
+  def __init__(self, etool, index, metadata_cache=None, ext_map=lch.default_ext_map):
+    self.etool = etool
+    self.index = index
+    self.metadata_cache = metadata_cache
+    self.ext_map = ext_map
+
+  def __call__(self, changed, deleted, deleted_dirs):
+    file_list = [(p, lch.media_type(p, self.ext_map)) for p in changed if os.path.exists(p)]
+    file_list = [fi for fi in file_list if fi[1] is not None]
+    gone = [p for p in deleted if lch.media_type(p, self.ext_map) is not None]
+    if self.metadata_cache is not None:
+      self.metadata_cache.invalidate([fi[0] for fi in file_list] + gone)
+    self.index.remove(gone)
+    for d in deleted_dirs:
+      self.index.remove_under(d)
+    if len(file_list):
+      self.index.index_files(self.etool, file_list)
+    logger.debug('Indexed {:d} changed files, removed {:d}'.format(len(file_list), len(gone) + len(deleted_dirs)))